@@ -1,21 +1,31 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
-import tempfile
 from jinja2 import FileSystemBytecodeCache
-from flask_compress import Compress
 from config import Config, ensure_database_exists
 from extensions import db, login_manager, csrf, limiter
-from routes.auth import auth_bp
-from routes.main import main_bp
-from routes.admin import admin_bp
-from models.user import User
+from utils.json_provider import OrjsonProvider
+from utils.uploads import UploadRequest
+
+# Added to every response by add_security_headers
+_SECURITY_HEADERS = [
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Strict-Transport-Security', 'max-age=31536000; includeSubDomains'),
+]
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.json = OrjsonProvider(app)
+    app.request_class = UploadRequest
 
-    # Ensure database exists before initializing SQLAlchemy
-    ensure_database_exists()
+    # Behind nginx: trust X-Forwarded-* from that many proxies so the limiter
+    # and url_for see the real client IP and scheme.
+    if app.config.get('TRUSTED_PROXY_COUNT'):
+        hops = app.config['TRUSTED_PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
 
     # Initialize Extensions
     db.init_app(app)
@@ -23,50 +33,85 @@ def create_app(config_class=Config):
     login_manager.login_view = 'auth.login'
     csrf.init_app(app)
     limiter.init_app(app)
-    Compress(app)
 
     # Configure Caching
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000  # 1 year for static files
-    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=tempfile.gettempdir())
+    # App-owned (0700) bytecode cache instead of the world-writable system temp dir
+    jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(jinja_cache_dir, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=jinja_cache_dir, pattern='__jinja2_%s.cache')
+    if not app.debug:
+        app.jinja_env.auto_reload = False
 
-    # Register Blueprints
+    # Register Blueprints (imported here so importing this module stays cheap;
+    # the routes pull in models, services and their SDKs)
+    from routes.auth import auth_bp
+    from routes.main import main_bp
+    from routes.admin import admin_bp
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
     app.register_blueprint(admin_bp, url_prefix='/admin')
 
-    # Create Database Tables
-    with app.app_context():
-        db.create_all()
+    # Warm the bytecode cache so the first request for each page skips parse/compile
+    for template_name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(template_name)
+        except Exception as e:
+            app.logger.warning(f"Could not precompile template {template_name}: {e}")
 
-    # Add Security Headers
-    # Serve Favicon
-    @app.route('/favicon.ico')
-    def favicon():
-        return send_from_directory(os.path.join(app.root_path, 'static', 'images'),
-                                   'favicon.ico', mimetype='image/vnd.microsoft.icon')
+    # Static files and trivial probes must not consume the per-IP default limits
+    # (or cost a limiter storage round-trip). CSRF needs no exemption: it only
+    # checks unsafe methods, and these are all GETs.
+    @limiter.request_filter
+    def _skip_static_rate_limit():
+        return request.endpoint == 'static'
 
     @app.route('/.well-known/appspecific/com.chrome.devtools.json')
+    @limiter.exempt
     def chrome_devtools():
-        return jsonify({}), 200
+        return Response(b'{}\n', mimetype='application/json',
+                        headers={'Cache-Control': 'public, max-age=86400'})
+
+    @app.errorhandler(413)
+    def request_too_large_handler(e):
+        # MAX_CONTENT_LENGTH is enforced before the upload body is read
+        return jsonify(error="File is too large. Maximum allowed size is 50 MB."), 413
 
     @app.errorhandler(429)
     def ratelimit_handler(e):
         return jsonify(error="ratelimit exceeded", message=str(e.description)), 429
 
-    @app.route('/test-marked')
-    def test_marked():
-        return send_from_directory(os.path.join(app.root_path, 'static'), 'reproduce_marked.html')
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the database and all tables (run once per deployment)."""
+        init_db(app)
+        print("Database tables are ready.")
 
     @app.after_request
     def add_security_headers(response):
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['X-Frame-Options'] = 'DENY'
-        response.headers['X-XSS-Protection'] = '1; mode=block'
-        response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
+        response.headers.extend(_SECURITY_HEADERS)
         return response
 
     return app
 
+def init_db(app):
+    """One-shot database bootstrap: create the schema and its tables.
+
+    Kept out of create_app so that forked Gunicorn workers do not all race
+    on DDL at boot; gunicorn.conf.py runs this once in the master process
+    and it is also exposed as `flask init-db`.
+    """
+    # Ensure database exists before touching SQLAlchemy
+    ensure_database_exists()
+
+    # Create Database Tables
+    with app.app_context():
+        db.create_all()
+        # create_all never alters existing tables; add columns the ORM now selects
+        from migrations.migrate_add_metadata_version import add_metadata_version_column
+        add_metadata_version_column()
+
 if __name__ == '__main__':
     app = create_app()
+    init_db(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -6,25 +6,62 @@ import pymysql
 load_dotenv()
 
 
+def _db_settings():
+    """MySQL connection settings from the environment: (user, password, host, database)."""
+    return (
+        os.environ.get('DB_USER', 'root'),
+        os.environ.get('DB_PASSWORD', 'password'),
+        os.environ.get('DB_HOST', 'localhost'),
+        os.environ.get('DB_NAME', 'simon_brain'),
+    )
+
+
+def build_database_uri():
+    """SQLAlchemy URI: DATABASE_URL if provided, else built from the DB_* settings."""
+    if os.environ.get('DATABASE_URL'):
+        return os.environ['DATABASE_URL']
+    db_user, db_password, db_host, db_name = _db_settings()
+    # URL-encode the password so special characters like @, :, / etc. are handled safely
+    return f'mysql+pymysql://{db_user}:{quote_plus(db_password)}@{db_host}/{db_name}'
+
+
 def ensure_database_exists():
     """Create the database if it doesn't exist"""
-    db_user = os.environ.get('DB_USER', 'root')
-    db_password = os.environ.get('DB_PASSWORD', 'password')
-    db_host = os.environ.get('DB_HOST', 'localhost')
-    db_name = os.environ.get('DB_NAME', 'simon_brain')
-    
+    # Deployments whose database is provisioned separately can skip the bootstrap entirely
+    if os.environ.get('SKIP_DB_BOOTSTRAP', '').lower() in ('1', 'true', 'yes', 'y'):
+        return True
+
+    db_user, db_password, db_host, db_name = _db_settings()
+
     try:
+        # Usual case: the database already exists, so a plain connect to it is enough
+        try:
+            pymysql.connect(
+                host=db_host,
+                user=db_user,
+                password=db_password,
+                database=db_name,
+                connect_timeout=10
+            ).close()
+            print(f"Database '{db_name}' is ready (already exists)")
+            return True
+        except pymysql.err.OperationalError as e:
+            if e.args[0] != 1049:  # ER_BAD_DB_ERROR: unknown database
+                raise
+
         connection = pymysql.connect(
             host=db_host,
             user=db_user,
-            password=db_password
+            password=db_password,
+            connect_timeout=10
         )
-        
-        with connection.cursor() as cursor:
-            cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{db_name}` DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
-            print(f"Database '{db_name}' is ready (created or already exists)")
-        
-        connection.close()
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{db_name}` DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+                print(f"Database '{db_name}' is ready (created or already exists)")
+        finally:
+            connection.close()
         return True
     except Exception as e:
         print(f"Error ensuring database exists: {e}")
@@ -34,19 +71,20 @@ def ensure_database_exists():
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-key-please-change-in-prod'
 
-    # Database Configuration
-    DB_USER = os.environ.get('DB_USER', 'root')
-    # URL‑encode the password so special characters like @, :, / etc. are handled safely
-    _raw_password = os.environ.get('DB_PASSWORD', 'password')
-    DB_PASSWORD = quote_plus(_raw_password)
-    DB_HOST = os.environ.get('DB_HOST', 'localhost')
-    DB_NAME = os.environ.get('DB_NAME', 'simon_brain')
-
-    # Fallback to DATABASE_URL if provided, else construct from components
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
-        f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
-    
+    # Database Configuration (credentials are only used to build the URI, not kept as attributes)
+    SQLALCHEMY_DATABASE_URI = build_database_uri()
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool (per worker process). pre_ping + recycle avoid handing out
+    # connections that MySQL already closed via wait_timeout.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 20)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 40)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
     
     # Uploads
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
@@ -55,17 +93,37 @@ class Config:
 
     # Gemini
     GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+    # Seconds to wait for an uploaded file to become ACTIVE before giving up
+    GEMINI_FILE_ACTIVE_TIMEOUT = float(os.environ.get('GEMINI_FILE_ACTIVE_TIMEOUT', 15))
+    # Pick a question's files by embedding similarity instead of a Gemini routing prompt
+    USE_EMBEDDING_ROUTER = os.environ.get('USE_EMBEDDING_ROUTER', 'false').lower() in ('true', '1', 'yes', 'y')
+    GEMINI_EMBEDDING_MODEL = os.environ.get('GEMINI_EMBEDDING_MODEL', 'text-embedding-004')
     
     # App Settings (paths aligned with old_code: process_metadata, process_file_cache_detail)
     _BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     PROCESS_METADATA_DIR = os.environ.get('PROCESS_METADATA_DIR') or os.path.join(_BASE_DIR, 'process_metadata')
     PROCESS_FILE_CACHE_DIR = os.path.join(_BASE_DIR, 'process_file_cache_detail')
     PROJECT_DOCS_DIR = os.environ.get('PROJECT_DOCS_DIR') or os.path.join(_BASE_DIR, 'Project_document_data')
+    # Legacy per-project folders created by add_project; containerised deploys that
+    # do not use them can switch each one off
+    CREATE_PROCESS_METADATA_DIRS = os.environ.get('CREATE_PROCESS_METADATA_DIRS', 'true').lower() in ('true', '1', 'yes', 'y')
+    CREATE_FILE_CACHE_DIRS = os.environ.get('CREATE_FILE_CACHE_DIRS', 'true').lower() in ('true', '1', 'yes', 'y')
+    CREATE_PAST_CONVERSATION_DIRS = os.environ.get('CREATE_PAST_CONVERSATION_DIRS', 'true').lower() in ('true', '1', 'yes', 'y')
+    # Optional folder of starter CSV/JSON files copied into each new project's process_metadata folder
+    PROJECT_INIT_TEMPLATE_DIR = os.environ.get('PROJECT_INIT_TEMPLATE_DIR')
     
+    # Document downloads: either Apache/lighttpd X-Sendfile (Flask built-in) or an
+    # internal nginx location that maps to PROJECT_DOCS_DIR (X-Accel-Redirect)
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'false').lower() in ('true', '1', 'yes', 'y')
+    X_ACCEL_DOCS_PREFIX = os.environ.get('X_ACCEL_DOCS_PREFIX')
+
     # Project document storage (local vs S3)
     USE_S3_FOR_PROJECT_DOCS = os.environ.get('USE_S3_FOR_PROJECT_DOCS', 'false').lower() in ('true', '1', 'yes', 'y')
     S3_PROJECT_DOCS_BUCKET = os.environ.get('S3_PROJECT_DOCS_BUCKET')
     S3_PROJECT_DOCS_PREFIX = os.environ.get('S3_PROJECT_DOCS_PREFIX', '')
+    # Redirect downloads to presigned S3 URLs; when off (e.g. the bucket is not
+    # reachable from browsers) the app streams the object through in chunks
+    S3_PRESIGNED_DOWNLOADS = os.environ.get('S3_PRESIGNED_DOWNLOADS', 'true').lower() in ('true', '1', 'yes', 'y')
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
     AWS_REGION = os.environ.get('AWS_REGION')
@@ -73,9 +131,29 @@ class Config:
     # Security Settings
     WTF_CSRF_ENABLED = True
     WTF_CSRF_TIME_LIMIT = None
-    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', "memory://")
-    RATELIMIT_STRATEGY = "fixed-window"
+
+    # Redis (shared across Gunicorn workers). Leave REDIS_URL unset for single-process dev.
+    REDIS_URL = os.environ.get('REDIS_URL')
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 20))
+
+    # Rate limiting: memory:// keeps separate counters per worker, so point the limiter
+    # at Redis in production. The moving window is evaluated by the `limits` Redis
+    # backend as a single pre-loaded Lua script (EVALSHA), i.e. one atomic round-trip.
+    RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI') or \
+        os.environ.get('RATELIMIT_STORAGE_URL') or REDIS_URL or "memory://"
+    RATELIMIT_STORAGE_OPTIONS = {'max_connections': REDIS_MAX_CONNECTIONS} \
+        if RATELIMIT_STORAGE_URI.startswith(('redis://', 'rediss://')) else {}
+    RATELIMIT_STRATEGY = "moving-window"
     
+    # Audit successful admin GET requests (page views) as well as admin changes
+    AUDIT_ADMIN_READS = os.environ.get('AUDIT_ADMIN_READS', 'true').lower() in ('true', '1', 'yes', 'y')
+    # Write audit rows from a background thread; when off they are written once per request
+    AUDIT_LOG_ASYNC = os.environ.get('AUDIT_LOG_ASYNC', 'true').lower() in ('true', '1', 'yes', 'y')
+
+    # Number of reverse proxies (e.g. nginx) in front of the app; 0 = served directly.
+    # Only set this when a proxy is present, otherwise clients can spoof their IP.
+    TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+
     # Only secure cookies if in production (using HTTPS)
     SESSION_COOKIE_SECURE = os.environ.get('FLASK_ENV') == 'production'
     SESSION_COOKIE_HTTPONLY = True
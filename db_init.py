@@ -1,30 +1,35 @@
 import os
 import pandas as pd
 from flask import Flask
-from config import Config, ensure_database_exists
+from config import Config
 from extensions import db, login_manager
 from models.user import User
 from models.project import Project, ProjectMetadata
 from models.audit import AuditLog
 from werkzeug.security import generate_password_hash
+from app import init_db
+from services import project_cache
+
+# Only these metadata.csv columns are used (s_no is ignored)
+METADATA_COLUMNS = ['file_path', 'file_name', 'type_of_data']
+CSV_CHUNK_SIZE = 5000
 
 def create_app_context():
     app = Flask(__name__)
     app.config.from_object(Config)
-    
-    ensure_database_exists()
-    
+
     db.init_app(app)
     login_manager.init_app(app)
     return app
 
 def seed_data():
     app = create_app_context()
-    with app.app_context():
-        # Create Tables
-        print("Creating database tables...")
-        db.create_all()
 
+    # Create Database and Tables
+    print("Creating database tables...")
+    init_db(app)
+
+    with app.app_context():
         # 1. Create Admin User (credentials from environment, with sensible defaults)
         admin_email = os.environ.get('ADMIN_EMAIL', 'admin@adventz.com')
         admin_password = os.environ.get('ADMIN_PASSWORD', 'admin123')
@@ -65,26 +70,47 @@ def seed_data():
             if csv_path:
                 print(f"Loading metadata from {csv_path}...")
                 try:
-                    df = pd.read_csv(csv_path)
-                    df.columns = [c.strip().lower() for c in df.columns]
-                    
+                    # One SELECT for the paths already stored instead of one per CSV row
+                    existing = {
+                        r.file_path for r in ProjectMetadata.query
+                        .with_entities(ProjectMetadata.file_path)
+                        .filter_by(project_id=project.id)
+                    }
+
                     count = 0
-                    for _, row in df.iterrows():
-                        f_path = row.get('file_path')
-                        f_name = row.get('file_name')
-                        if not f_path: continue
-                        
-                        exists = ProjectMetadata.query.filter_by(project_id=project.id, file_path=f_path).first()
-                        if not exists:
-                            meta = ProjectMetadata(
-                                project_id=project.id,
-                                type_of_data=row.get('type_of_data'),
-                                file_name=f_name,
-                                file_path=f_path
-                                # Note: s_no from CSV is ignored; using id (auto-increment) instead
-                            )
-                            db.session.add(meta)
-                            count += 1
+                    # Read in chunks so memory stays flat regardless of CSV size
+                    for df in pd.read_csv(
+                        csv_path,
+                        usecols=lambda c: c.strip().lower() in METADATA_COLUMNS,
+                        dtype='string',
+                        chunksize=CSV_CHUNK_SIZE
+                    ):
+                        df = df.rename(columns={c: c.strip().lower() for c in df.columns})
+                        # Missing columns are added as empty; blank cells are stored as NULL
+                        df = df.reindex(columns=METADATA_COLUMNS)
+                        df = df.astype(object).where(df.notna(), None)
+
+                        rows = []
+                        for f_path, f_name, type_of_data in zip(
+                            df['file_path'].values, df['file_name'].values, df['type_of_data'].values
+                        ):
+                            if not f_path or f_path in existing:
+                                continue
+                            existing.add(f_path)
+                            # Note: s_no from CSV is ignored; using id (auto-increment) instead
+                            rows.append({
+                                'project_id': project.id,
+                                'type_of_data': type_of_data,
+                                'file_name': f_name,
+                                'file_path': f_path,
+                            })
+
+                        if rows:
+                            # Core executemany: no ORM objects or identity-map bookkeeping
+                            db.session.execute(ProjectMetadata.__table__.insert(), rows)
+                            count += len(rows)
+                    if count:
+                        project_cache.bump_metadata_version(project.id)
                     print(f"Added {count} items for {p_name}")
                 except Exception as e:
                     print(f"Error loading {csv_path}: {e}")
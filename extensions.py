@@ -3,6 +3,8 @@ from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from flask import current_app
+import redis
 
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -17,3 +19,16 @@ limiter = Limiter(
 def load_user(user_id):
     from models.user import User
     return User.query.get(int(user_id))
+
+
+def get_redis():
+    """Return the app's shared Redis client, or None when REDIS_URL is not configured."""
+    app = current_app._get_current_object()
+    if 'redis' not in app.extensions:
+        url = app.config.get('REDIS_URL')
+        app.extensions['redis'] = redis.Redis.from_url(
+            url,
+            max_connections=app.config.get('REDIS_MAX_CONNECTIONS', 20),
+            decode_responses=True
+        ) if url else None
+    return app.extensions['redis']
@@ -0,0 +1,48 @@
+"""Gunicorn configuration for production deployments.
+
+Usage:
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# One process per core (2*cpu+1) sidesteps the GIL for CPU-bound work such as
+# Jinja rendering, JSON serialization and PDF page rendering. Chat requests
+# spend seconds blocked on Gemini with the GIL released, so each gthread worker
+# runs enough threads to keep many of those calls in flight at once.
+# Keep workers * threads within the database pool (DB_POOL_SIZE + DB_MAX_OVERFLOW per process).
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 12))
+
+# With GUNICORN_WORKER_CLASS=gevent (pip install gevent) each open chat stream
+# is a greenlet instead of an OS thread, so a worker can hold far more
+# concurrent streams than GUNICORN_THREADS allows.
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Streaming chat responses can stay open for a long time.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+
+# Load the application once in the master so workers share its memory pages.
+# gevent must patch the standard library before the app creates its locks and
+# thread pools, so the app is loaded in each worker instead.
+preload_app = worker_class != 'gevent'
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """Create the database and its tables once, before any worker is forked."""
+    from app import create_app, init_db
+    from extensions import db
+
+    app = create_app()
+    init_db(app)
+    # Do not let forked workers inherit the bootstrap connections
+    with app.app_context():
+        db.engine.dispose()
@@ -0,0 +1,57 @@
+"""
+Migration script to add the composite indexes declared on the models
+to databases created before they existed (db.create_all() never alters
+existing tables).
+"""
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from flask import Flask
+from config import Config
+from extensions import db
+from sqlalchemy import text
+
+# (table, index name, column list)
+INDEXES = [
+    ('conversation', 'ix_conv_session_ts', 'session_id, timestamp'),
+    ('conversation', 'ix_conv_user_project', 'user_id, project_id'),
+    ('chat_session', 'ix_cs_user_updated', 'user_id, updated_at'),
+    ('conversation', 'ix_conv_user_pinned_ts', 'user_id, is_pinned, timestamp DESC'),
+    ('chat_session', 'ix_cs_user_proj_pinned_upd', 'user_id, project_id, is_pinned DESC, updated_at DESC'),
+    ('project_metadata', 'ix_pm_project_file', 'project_id, file_path'),
+    ('project_dependency', 'ix_dep_project_name', 'project_name'),
+]
+
+
+def migrate():
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            # One lookup for every existing index instead of one query per index
+            existing = {
+                (row[0], row[1]) for row in db.session.execute(text("""
+                    SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE()
+                """))
+            }
+
+            for table, name, columns in INDEXES:
+                if (table, name) in existing:
+                    print(f"[OK] Index '{name}' already exists on {table}")
+                    continue
+                db.session.execute(text(f"CREATE INDEX {name} ON {table} ({columns})"))
+                print(f"[OK] Created index '{name}' on {table} ({columns})")
+
+            db.session.commit()
+        except Exception as e:
+            print(f"Error: {e}")
+            db.session.rollback()
+            raise
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,50 @@
+"""
+Migration script to add metadata_version column to project table
+Run this script to update the database schema (`flask init-db` also applies it).
+"""
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from flask import Flask
+from config import Config
+from extensions import db
+from sqlalchemy import text
+
+def add_metadata_version_column():
+    """Add project.metadata_version if it is missing; needs an app context."""
+    # Check if column already exists
+    result = db.session.execute(text("""
+        SELECT COLUMN_NAME 
+        FROM INFORMATION_SCHEMA.COLUMNS 
+        WHERE TABLE_SCHEMA = DATABASE()
+        AND TABLE_NAME = 'project' 
+        AND COLUMN_NAME = 'metadata_version'
+    """)).fetchone()
+
+    if result:
+        print("✓ Column 'metadata_version' already exists. No migration needed.")
+        return
+    print("Adding 'metadata_version' column to 'project' table...")
+    db.session.execute(text("""
+        ALTER TABLE project 
+        ADD COLUMN metadata_version INT NOT NULL DEFAULT 0
+    """))
+    db.session.commit()
+    print("✓ Successfully added 'metadata_version' column!")
+
+def migrate():
+    # Create minimal Flask app for database context
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    
+    with app.app_context():
+        try:
+            add_metadata_version_column()
+        except Exception as e:
+            print(f"Error during migration: {e}")
+            db.session.rollback()
+            raise
+
+if __name__ == '__main__':
+    migrate()
@@ -7,15 +7,13 @@ import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from app import create_app
-from extensions import db
+from app import create_app, init_db
 
 
 def migrate():
     app = create_app()
-    with app.app_context():
-        db.create_all()
-        print("[OK] comparison_upload table ensured (create_all).")
+    init_db(app)
+    print("[OK] comparison_upload table ensured (create_all).")
 
 
 if __name__ == "__main__":
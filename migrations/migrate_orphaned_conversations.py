@@ -5,6 +5,7 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from flask import Flask
+from sqlalchemy import update
 from config import Config
 from extensions import db
 from models.conversation import ChatSession, Conversation
@@ -46,13 +47,17 @@ def migrate():
                     title=f"Migrated Chat: {title}"
                 )
                 db.session.add(session)
-                db.session.commit() # Get session ID
+                db.session.flush() # Get session ID (committed once at the end)
                 
                 print(f"Created session '{session.title}' for User {u_id} and Project {p_id}")
                 
-                # Link conversations to this session
-                for conv in convs:
-                    conv.session_id = session.id
+                # Link conversations to this session with a single UPDATE
+                db.session.execute(
+                    update(Conversation)
+                    .where(Conversation.id.in_([conv.id for conv in convs]))
+                    .values(session_id=session.id)
+                    .execution_options(synchronize_session=False)
+                )
                 
             db.session.commit()
             print("✓ Successfully migrated all orphaned conversations!")
@@ -19,6 +19,15 @@ def migrate():
             # Ensure chat_session table exists
             db.create_all()
             
+            # Look up every chat-related column once; all ALTER decisions below use this result
+            existing_columns = {
+                (row[0], row[1]): row[2] or '' for row in db.session.execute(text("""
+                    SELECT TABLE_NAME, COLUMN_NAME, EXTRA FROM INFORMATION_SCHEMA.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE()
+                    AND TABLE_NAME IN ('chat_session', 'conversation')
+                """))
+            }
+
             # Check and add chat_session columns
             columns_to_check = [
                 ('title', "VARCHAR(255) DEFAULT 'New Chat'"),
@@ -27,14 +36,7 @@ def migrate():
             ]
             
             for col_name, col_def in columns_to_check:
-                result = db.session.execute(text(f"""
-                    SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'chat_session' 
-                    AND COLUMN_NAME = '{col_name}'
-                """)).fetchone()
-                
-                if not result:
+                if ('chat_session', col_name) not in existing_columns:
                     db.session.execute(text(f"ALTER TABLE chat_session ADD COLUMN {col_name} {col_def}"))
                     db.session.commit()
                     print(f"[OK] Added '{col_name}' to chat_session")
@@ -43,15 +45,7 @@ def migrate():
                     
                     # Comment 2: Ensure updated_at has ON UPDATE behavior
                     if col_name == 'updated_at':
-                        extra = db.session.execute(text(f"""
-                            SELECT EXTRA FROM INFORMATION_SCHEMA.COLUMNS 
-                            WHERE TABLE_SCHEMA = DATABASE()
-                            AND TABLE_NAME = 'chat_session' 
-                            AND COLUMN_NAME = 'updated_at'
-                        """)).scalar()
-                        
-                        if extra is None:
-                            extra = ''
+                        extra = existing_columns[('chat_session', col_name)]
                         
                         if 'on update' not in extra.lower():
                             db.session.execute(text(f"ALTER TABLE chat_session MODIFY COLUMN {col_name} {col_def}"))
@@ -59,14 +53,7 @@ def migrate():
                             print(f"[OK] Fix: Added ON UPDATE CURRENT_TIMESTAMP to '{col_name}'")
             
             # Check conversation.session_id
-            result = db.session.execute(text("""
-                SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_SCHEMA = DATABASE()
-                AND TABLE_NAME = 'conversation' 
-                AND COLUMN_NAME = 'session_id'
-            """)).fetchone()
-            
-            if not result:
+            if ('conversation', 'session_id') not in existing_columns:
                 db.session.execute(text("""
                     ALTER TABLE conversation 
                     ADD COLUMN session_id INT,
@@ -1,5 +1,19 @@
 from extensions import db
 from datetime import datetime
+import orjson
+
+
+class JSONText(db.TypeDecorator):
+    """A JSON value stored in a TEXT column, encoded and decoded with orjson."""
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return orjson.dumps(value).decode('utf-8') if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return orjson.loads(value) if value else None
+
 
 class ChatSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -13,6 +27,9 @@ class ChatSession(db.Model):
 
     messages = db.relationship('Conversation', backref='session', lazy=True, cascade="all, delete-orphan")
 
+    # Sidebar/session listings filter by user and sort by most recent activity
+    __table_args__ = (db.Index('ix_cs_user_updated', 'user_id', 'updated_at'),)
+
 class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=True)
@@ -20,7 +37,21 @@ class Conversation(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     question = db.Column(db.Text, nullable=False)
     answer = db.Column(db.Text, nullable=False)
-    relevant_files = db.Column(db.Text, nullable=True)
-    visuals = db.Column(db.Text, nullable=True)
+    relevant_files = db.Column(JSONText, nullable=True)
+    visuals = db.Column(JSONText, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_pinned = db.Column(db.Boolean, default=False)
+
+    # History is read per session in timestamp order; sidebars filter by user + project.
+    # Answers are long, repetitive markdown, so the table is stored compressed (InnoDB zlib).
+    __table_args__ = (
+        db.Index('ix_conv_session_ts', 'session_id', 'timestamp'),
+        db.Index('ix_conv_user_project', 'user_id', 'project_id'),
+        {'mysql_row_format': 'COMPRESSED', 'mysql_key_block_size': '8'},
+    )
+
+# Sidebar queries: recent unpinned chats per user (every rendered page) and a
+# project's sessions with pinned ones first, both newest first
+db.Index('ix_conv_user_pinned_ts', Conversation.user_id, Conversation.is_pinned, Conversation.timestamp.desc())
+db.Index('ix_cs_user_proj_pinned_upd', ChatSession.user_id, ChatSession.project_id,
+         ChatSession.is_pinned.desc(), ChatSession.updated_at.desc())
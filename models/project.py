@@ -5,6 +5,9 @@ class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False) # DAP, SAP, etc.
     description = db.Column(db.String(200))
+    # Incremented whenever one of the project's metadata rows is added, edited or deleted,
+    # so cached per-project metadata listings can tell they are stale
+    metadata_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # Relationships
     metadata_items = db.relationship('ProjectMetadata', backref='project', lazy=True)
     conversations = db.relationship('Conversation', backref='project', lazy=True)
@@ -16,6 +19,9 @@ class ProjectMetadata(db.Model):
     file_name = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
     type_of_data = db.Column(db.String(500))  # was 100; increased to avoid MySQL 1406 "Data too long"
+
+    # Lookups by (project_id, file_path) when seeding and resolving documents
+    __table_args__ = (db.Index('ix_pm_project_file', 'project_id', 'file_path'),)
     
     def to_dict(self):
         return {
@@ -30,6 +36,9 @@ class ProjectDependency(db.Model):
     project_name = db.Column(db.String(50), nullable=False) # Source project
     dependency_name = db.Column(db.String(50), nullable=False) # Target dependency
 
+    # Dependencies are always read, replaced and deleted per source project
+    __table_args__ = (db.Index('ix_dep_project_name', 'project_name'),)
+
 class FileUploadCache(db.Model):
     """
     Cache for Gemini file uploads to avoid re-uploading the same files.
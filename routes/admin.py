@@ -2,21 +2,32 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required, current_user
 from models.project import Project, ProjectMetadata, ProjectDependency
 from models.user import User
-from models.audit import AuditLog
 from extensions import db, csrf
 from flask_wtf.csrf import CSRFError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 import os
 import werkzeug.utils
-import io
+from collections import defaultdict
+from urllib.parse import quote
 import tempfile
-import json
+import orjson
+import shutil
+import threading
 import time
 
 from services.document_storage import get_document_storage
-from services.gemini_service import GeminiService
+from services import audit_queue, description_cache, project_cache
+from services.gemini_service import get_gemini_service
+from utils.uploads import spooled_upload_path
+from routes.auth import forget_unknown_email
 
 admin_bp = Blueprint('admin', __name__)
 
+# Project folders already created by this process, so repeat calls skip the makedirs syscalls
+_FS_INIT_CACHE: set = set()
+_FS_INIT_LOCK = threading.Lock()
+
 
 def initialize_project_filesystem(process_name: str) -> None:
     """
@@ -25,71 +36,108 @@ def initialize_project_filesystem(process_name: str) -> None:
     to work (process_metadata, process_file_cache_detail, etc.).
     """
     try:
+        config = current_app.config
         base_root = os.path.abspath(os.path.join(current_app.root_path, '..'))
 
-        # Core folders (aligned with old_code: project_document_data lowercase)
-        folders = {
-            "process_metadata": os.path.join(base_root, "process_metadata", process_name),
-            "process_file_cache_detail": os.path.join(base_root, "process_file_cache_detail", process_name),
-            "past_conversation": os.path.join(base_root, "past_conversation", process_name),
-        }
+        # Core folders (aligned with old_code: project_document_data lowercase),
+        # each of which a deployment can switch off
+        folders = {}
+        if config.get("CREATE_PROCESS_METADATA_DIRS", True):
+            folders["process_metadata"] = os.path.join(base_root, "process_metadata", process_name)
+        if config.get("CREATE_FILE_CACHE_DIRS", True):
+            folders["process_file_cache_detail"] = os.path.join(base_root, "process_file_cache_detail", process_name)
+        if config.get("CREATE_PAST_CONVERSATION_DIRS", True):
+            folders["past_conversation"] = os.path.join(base_root, "past_conversation", process_name)
 
         # Only create local project_document_data folder when not using S3 for project docs
-        if not current_app.config.get("USE_S3_FOR_PROJECT_DOCS"):
+        if not config.get("USE_S3_FOR_PROJECT_DOCS"):
             folders["project_document_data"] = os.path.join(base_root, "project_document_data", process_name)
 
-        for path in folders.values():
+        if not folders:
+            return
+
+        with _FS_INIT_LOCK:
+            paths_to_make = [p for p in folders.values() if p not in _FS_INIT_CACHE]
+        for path in paths_to_make:
             os.makedirs(path, exist_ok=True)
+            with _FS_INIT_LOCK:
+                _FS_INIT_CACHE.add(path)
+
+        # Seed the metadata folder from the prebuilt starter files, if configured
+        template_dir = config.get("PROJECT_INIT_TEMPLATE_DIR")
+        if template_dir and folders.get("process_metadata") in paths_to_make:
+            _copy_project_init_templates(template_dir, folders["process_metadata"])
     except Exception as e:
         current_app.logger.error(f"Failed to initialise filesystem for process {process_name}: {e}")
 
+
+def _copy_project_init_templates(template_dir: str, dest_dir: str) -> None:
+    """
+    Copy each starter file (CSV/JSON) from template_dir into a new project's folder.
+    shutil.copyfile lets the kernel copy the bytes (copy_file_range/sendfile on Linux);
+    files the project already has are left untouched.
+    """
+    for entry in os.scandir(template_dir):
+        if not entry.is_file():
+            continue
+        dest = os.path.join(dest_dir, entry.name)
+        if not os.path.exists(dest):
+            shutil.copyfile(entry.path, dest)
+
 @admin_bp.errorhandler(CSRFError)
 def handle_csrf_error(e):
     flash('CSRF token missing or invalid. Please try again.', 'danger')
     return redirect(url_for('admin.index'))
 
+@admin_bp.errorhandler(413)
+def handle_request_too_large(e):
+    # Raised by MAX_CONTENT_LENGTH before the upload body is read
+    message = 'File is too large. Maximum allowed size is 50 MB.'
+    if request.endpoint == 'admin.generate_description':
+        return jsonify({'error': message}), 413
+    flash(message, 'danger')
+    return redirect(url_for('admin.index', _anchor='metadata'))
+
 @admin_bp.before_request
 def admin_only():
     # Enforce authentication and admin role
     if not current_user.is_authenticated or current_user.role != 'admin':
         # Log failed admin access attempts
-        try:
-            user_email = current_user.email if current_user.is_authenticated else 'Anonymous'
-            log = AuditLog(
-                user_id=user_email,
-                action='ADMIN_ACCESS_ATTEMPT',
-                details=f"Failed admin access - User role: {getattr(current_user, 'role', 'None')}"
-            )
-            db.session.add(log)
-            db.session.commit()
-        except Exception as e:
-            current_app.logger.error(f"Audit Log Failed: {e}")
-        
+        user_email = current_user.email if current_user.is_authenticated else 'Anonymous'
+        audit_queue.log_event(
+            user_email,
+            'ADMIN_ACCESS_ATTEMPT',
+            f"Failed admin access - User role: {getattr(current_user, 'role', 'None')}"
+        )
         return "Access Denied", 403
     
-    # Log successful admin access
-    try:
-        log = AuditLog(
-            user_id=current_user.email,
-            action='ADMIN_ACCESS_ATTEMPT',
-            details=f"Successful admin access to {request.endpoint}"
-        )
-        db.session.add(log)
-        db.session.commit()
-    except Exception as e:
-        current_app.logger.error(f"Audit Log Failed: {e}")
+    # Log successful admin access (page views can be skipped via AUDIT_ADMIN_READS)
+    if request.method == 'GET' and not current_app.config.get('AUDIT_ADMIN_READS', True):
+        return
+    audit_queue.log_event(
+        current_user.email,
+        'ADMIN_ACCESS_ATTEMPT',
+        f"Successful admin access to {request.endpoint}"
+    )
 
 @admin_bp.route('/')
 def index():
     projects = Project.query.all()
-    metadata = ProjectMetadata.query.all()
+    # The template shows m.project.name for every row; load it in the same query
+    metadata = ProjectMetadata.query.options(joinedload(ProjectMetadata.project)).all()
     users = User.query.all()
+    # project name -> dependency names, built here in one query rather than in the template
+    dep_map = defaultdict(list)
+    for project_name, dependency_name in db.session.query(
+        ProjectDependency.project_name, ProjectDependency.dependency_name
+    ):
+        dep_map[project_name].append(dependency_name)
     return render_template(
         'admin/admin_dashboard.html',
         projects=projects,
         metadata=metadata,
         users=users,
-        ProjectDependency=ProjectDependency,
+        dep_map=dict(dep_map),
     )
 
 @admin_bp.route('/project/add', methods=['POST'])
@@ -100,15 +148,15 @@ def add_project():
         try:
             upper_name = name.upper()
 
-            # Prevent duplicate projects
-            existing = Project.query.filter_by(name=upper_name).first()
-            if existing:
-                flash(f'Project {upper_name} already exists.', 'danger')
-                return redirect(url_for('admin.index'))
-
+            # Duplicates are rejected by the unique index on project.name
             p = Project(name=upper_name, description=description)
             db.session.add(p)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                flash(f'Project {upper_name} already exists.', 'danger')
+                return redirect(url_for('admin.index'))
 
             # Mirror legacy filesystem initialisation (folders + CSV/JSON)
             initialize_project_filesystem(upper_name)
@@ -145,18 +193,19 @@ def update_project(id):
 
     upper_name = new_name.upper()
 
-    # Prevent renaming to an existing project's name
-    existing = Project.query.filter(Project.id != project.id, Project.name == upper_name).first()
-    if existing:
-        flash(f'Another project with name {upper_name} already exists.', 'danger')
-        return redirect(url_for('admin.edit_project', id=project.id))
-
     try:
         old_name = project.name
         project.name = upper_name
         project.description = description
         db.session.commit()
+        project_cache.invalidate(old_name)
+        project_cache.invalidate(upper_name)
         flash('Project updated successfully.', 'success')
+    except IntegrityError:
+        # Renaming to an existing project's name trips the unique index
+        db.session.rollback()
+        flash(f'Another project with name {upper_name} already exists.', 'danger')
+        return redirect(url_for('admin.edit_project', id=project.id))
     except Exception as e:
         db.session.rollback()
         flash(f'Error updating project: {e}', 'danger')
@@ -177,11 +226,13 @@ def delete_project(id):
         storage = get_document_storage()
 
         # Delete all metadata rows (and underlying files or S3 objects) for this project
-        metas = ProjectMetadata.query.filter_by(project_id=proj.id).all()
-        for meta in metas:
-            if meta.file_path:
-                storage.delete(meta.file_path)
-            db.session.delete(meta)
+        file_paths = [
+            row.file_path for row in ProjectMetadata.query
+            .with_entities(ProjectMetadata.file_path)
+            .filter_by(project_id=proj.id)
+        ]
+        storage.delete_many(file_paths)
+        ProjectMetadata.query.filter_by(project_id=proj.id).delete(synchronize_session=False)
 
         # Remove dependency mappings where this project is the source
         ProjectDependency.query.filter_by(project_name=proj.name).delete()
@@ -189,6 +240,7 @@ def delete_project(id):
         # Finally delete the project itself
         db.session.delete(proj)
         db.session.commit()
+        project_cache.invalidate(proj.name)
         flash(f'Project {proj.name} deleted successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -212,8 +264,8 @@ def generate_description():
 
     # region agent log
     try:
-        with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-            _f.write(json.dumps({
+        with open("debug-0484fb.log", "ab") as _f:
+            _f.write(orjson.dumps({
                 "sessionId": "0484fb",
                 "runId": "pre-fix-1",
                 "hypothesisId": "H1-H3",
@@ -226,7 +278,7 @@ def generate_description():
                     "content_type": getattr(file, "mimetype", None),
                 },
                 "timestamp": int(time.time() * 1000),
-            }) + "\n")
+            }) + b"\n")
     except Exception:
         pass
     # endregion
@@ -237,26 +289,34 @@ def generate_description():
     if not _is_pdf(file.filename):
         return jsonify({'error': 'Only PDF files are allowed for description generation.'}), 400
 
-    max_bytes = 50 * 1024 * 1024
-    if content_length > max_bytes:
-        return jsonify({'error': 'File is too large. Maximum allowed size is 50 MB.'}), 400
-
     api_key = current_app.config.get('GEMINI_API_KEY')
     if not api_key:
         return jsonify({'error': 'Gemini API Key not configured.'}), 500
 
-    fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(file.filename)[1])
+    # The same PDF always gets the same description; skip Gemini on a repeat upload
+    max_words = 50
+    digest = description_cache.content_digest(file)
+    cached_description = description_cache.get_description(digest, max_words)
+    if cached_description:
+        return jsonify({'description': cached_description})
+
+    # Large uploads are already on disk; only small in-memory ones need a temp copy
+    temp_path = spooled_upload_path(file)
+    owns_temp_file = temp_path is None
+    if owns_temp_file:
+        fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(file.filename)[1])
     try:
-        os.close(fd)
-        file.save(temp_path)
+        if owns_temp_file:
+            os.close(fd)
+            file.save(temp_path)
 
-        service = GeminiService(api_key=api_key)
-        description = service.generate_document_description(temp_path, max_words=50)
+        service = get_gemini_service()
+        description = service.generate_document_description(temp_path, max_words=max_words)
 
         # region agent log
         try:
-            with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-                _f.write(json.dumps({
+            with open("debug-0484fb.log", "ab") as _f:
+                _f.write(orjson.dumps({
                     "sessionId": "0484fb",
                     "runId": "pre-fix-1",
                     "hypothesisId": "H3",
@@ -267,7 +327,7 @@ def generate_description():
                         "description_len": len(description) if isinstance(description, str) else None,
                     },
                     "timestamp": int(time.time() * 1000),
-                }) + "\n")
+                }) + b"\n")
         except Exception:
             pass
         # endregion
@@ -278,13 +338,14 @@ def generate_description():
             # the UI shows a helpful message without a 500 status code.
             return jsonify({'error': 'Could not generate description from the document. Please enter it manually.'}), 200
 
+        description_cache.store_description(digest, max_words, description)
         return jsonify({'description': description})
     except Exception as e:
         current_app.logger.error(f"Error generating document description: {e}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred while generating the description.'}), 500
     finally:
         try:
-            if os.path.exists(temp_path):
+            if owns_temp_file and os.path.exists(temp_path):
                 os.remove(temp_path)
         except Exception as cleanup_error:
             current_app.logger.warning(f"Failed to remove temporary file {temp_path}: {cleanup_error}")
@@ -295,7 +356,6 @@ def upload_metadata():
     project_id = request.form.get('project_id')
     type_of_data = request.form.get('type_of_data')
     file = request.files.get('file')
-    content_length = request.content_length or 0
 
     if not file or not file.filename:
         flash('Please choose a PDF file before submitting.', 'danger')
@@ -303,11 +363,6 @@ def upload_metadata():
     if not _is_pdf(file.filename):
         flash('Only PDF files are allowed.', 'danger')
         return redirect(url_for('admin.index', _anchor='metadata'))
-    # Explicit server-side size check (matches global 50 MB limit)
-    max_bytes = 50 * 1024 * 1024
-    if content_length > max_bytes:
-        flash('File is too large. Maximum allowed size is 50 MB.', 'danger')
-        return redirect(url_for('admin.index', _anchor='metadata'))
     if not project_id:
         flash('Project is required.', 'danger')
         return redirect(url_for('admin.index', _anchor='metadata'))
@@ -319,16 +374,14 @@ def upload_metadata():
         return redirect(url_for('admin.index', _anchor='metadata'))
 
     storage = get_document_storage()
-    storage_id = storage.build_storage_id(proj.name, filename)
 
-    # Prevent accidental overwrite of an existing file
-    if storage.exists(storage_id):
+    # Save via storage abstraction (local or S3); refuses to overwrite an existing file
+    try:
+        final_storage_id = storage.save_pdf_exclusive(proj.name, filename, file)
+    except FileExistsError:
         flash('A file with the same name already exists for this project. Please rename and try again.', 'danger')
         return redirect(url_for('admin.index'))
 
-    # Save via storage abstraction (local or S3)
-    final_storage_id = storage.save_pdf(proj.name, filename, file)
-
     # Add to DB
     meta = ProjectMetadata(
         project_id=project_id,
@@ -338,6 +391,7 @@ def upload_metadata():
         type_of_data=type_of_data
     )
     db.session.add(meta)
+    project_cache.bump_metadata_version(proj.id)
     db.session.commit()
 
     flash('File uploaded and indexed.', 'success')
@@ -355,6 +409,7 @@ def delete_metadata(id):
         
         # Delete from DB
         db.session.delete(meta)
+        project_cache.bump_metadata_version(meta.project_id)
         db.session.commit()
 
         flash('File deleted.', 'success')
@@ -370,27 +425,71 @@ def download_metadata(id):
     try:
         storage = get_document_storage()
 
-        # Local filesystem: stream directly from disk
+        # Local filesystem: let nginx stream the file when configured, else send it
+        # conditionally (ETag / Last-Modified, 304 on revalidation; X-Sendfile if enabled)
         if not storage.use_s3:
-            return send_file(meta.file_path, as_attachment=True, download_name=meta.file_name)
-
-        # S3 mode: stream bytes from S3
-        data = storage.read_bytes(meta.file_path)
-        if data is None:
+            accel_path = _x_accel_path(meta.file_path)
+            if accel_path:
+                response = current_app.response_class(mimetype='application/pdf')
+                response.headers['X-Accel-Redirect'] = accel_path
+                response.headers.set('Content-Disposition', 'attachment', filename=meta.file_name)
+                return response
+            return send_file(meta.file_path, as_attachment=True, download_name=meta.file_name, conditional=True)
+
+        # S3 mode: send the browser straight to S3 with a short-lived presigned URL
+        if current_app.config.get('S3_PRESIGNED_DOWNLOADS', True):
+            url = storage.presigned_url(meta.file_path, download_name=meta.file_name)
+            if url:
+                return redirect(url, 302)
+
+        # Otherwise relay the object in 64 KB chunks instead of buffering the whole file
+        body, content_length = storage.open_stream(meta.file_path)
+        if body is None:
             flash('File not found in storage.', 'danger')
             return redirect(url_for('admin.index', _anchor='metadata'))
 
-        return send_file(
-            io.BytesIO(data),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=meta.file_name
-        )
+        response = current_app.response_class(body.iter_chunks(64 * 1024), mimetype='application/pdf')
+        response.call_on_close(body.close)
+        response.headers.set('Content-Disposition', 'attachment', filename=meta.file_name)
+        if content_length is not None:
+            response.content_length = content_length
+        return response
     except Exception as e:
         flash(f'Error downloading file: {e}', 'danger')
         return redirect(url_for('admin.index', _anchor='metadata'))
 
 
+def _same_storage_id(storage, current_id, new_id) -> bool:
+    """True if both identifiers point at the same stored document."""
+    if not current_id:
+        return False
+    if storage.use_s3:
+        # Object keys: plain string comparison
+        return current_id == new_id
+    try:
+        return os.path.samefile(current_id, new_id)
+    except OSError:
+        # One side does not exist (yet); fall back to comparing the normalised paths
+        return os.path.normpath(current_id) == os.path.normpath(new_id)
+
+
+def _x_accel_path(file_path: str):
+    """
+    Map a document under PROJECT_DOCS_DIR to the internal nginx location configured
+    in X_ACCEL_DOCS_PREFIX, or return None when X-Accel-Redirect is not in use.
+    """
+    prefix = current_app.config.get('X_ACCEL_DOCS_PREFIX')
+    base_dir = current_app.config.get('PROJECT_DOCS_DIR')
+    if not prefix or not base_dir or not file_path:
+        return None
+    base_dir = os.path.abspath(base_dir)
+    full_path = os.path.abspath(file_path)
+    if os.path.commonpath([base_dir, full_path]) != base_dir:
+        return None
+    relative = os.path.relpath(full_path, base_dir).replace(os.sep, '/')
+    return f"{prefix.rstrip('/')}/{quote(relative)}"
+
+
 @admin_bp.route('/metadata/edit/<int:id>')
 def edit_metadata(id):
     """
@@ -417,33 +516,38 @@ def update_metadata(id):
         if file and file.filename:
             filename = werkzeug.utils.secure_filename(file.filename)
 
-            storage = get_document_storage()
-            new_storage_id = storage.build_storage_id(project.name, filename)
-
-            # Block overwriting a different existing file
-            if storage.exists(new_storage_id) and os.path.abspath(str(new_storage_id)) != os.path.abspath(str(meta.file_path)):
-                flash('A file with this name already exists for this project. Please rename and try again.', 'danger')
-                return redirect(url_for('admin.edit_metadata', id=meta.id))
-
             # Only PDF allowed (same as old_code)
             if not _is_pdf(filename):
                 flash('Only PDF files are allowed.', 'danger')
                 return redirect(url_for('admin.edit_metadata', id=meta.id))
 
-            # Remove old file if it exists and path is different
-            if meta.file_path and os.path.abspath(str(meta.file_path)) != os.path.abspath(str(new_storage_id)):
+            storage = get_document_storage()
+            new_storage_id = storage.build_storage_id(project.name, filename)
+            same_file = _same_storage_id(storage, meta.file_path, new_storage_id)
+
+            # Save new file via storage abstraction; only the current file may be overwritten
+            if same_file:
+                final_storage_id = storage.save_pdf(project.name, filename, file)
+            else:
                 try:
-                    storage.delete(meta.file_path)
-                except Exception as e:
-                    current_app.logger.error(f"Failed to remove old metadata file {meta.file_path}: {e}")
+                    final_storage_id = storage.save_pdf_exclusive(project.name, filename, file)
+                except FileExistsError:
+                    flash('A file with this name already exists for this project. Please rename and try again.', 'danger')
+                    return redirect(url_for('admin.edit_metadata', id=meta.id))
+
+                # Remove the old file only once the replacement is safely stored
+                if meta.file_path:
+                    try:
+                        storage.delete(meta.file_path)
+                    except Exception as e:
+                        current_app.logger.error(f"Failed to remove old metadata file {meta.file_path}: {e}")
 
-            # Save new file via storage abstraction
-            final_storage_id = storage.save_pdf(project.name, filename, file)
             meta.file_name = filename
             meta.file_path = final_storage_id
 
         # Update metadata fields
         meta.type_of_data = type_of_data
+        project_cache.bump_metadata_version(meta.project_id)
 
         db.session.commit()
         flash('Metadata updated successfully.', 'success')
@@ -464,18 +568,17 @@ def add_user():
         flash('Email and password are required.', 'danger')
         return redirect(url_for('admin.index', _anchor='users'))
     
-    # Check if user already exists
-    existing_user = User.query.filter_by(email=email).first()
-    if existing_user:
-        flash(f'User with email {email} already exists.', 'danger')
-        return redirect(url_for('admin.index', _anchor='users'))
-    
     try:
         user = User(email=email, role=role)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
+        forget_unknown_email(email)
         flash(f'User {email} created successfully.', 'success')
+    except IntegrityError:
+        # Existing users are rejected by the unique index on user.email
+        db.session.rollback()
+        flash(f'User with email {email} already exists.', 'danger')
     except Exception as e:
         db.session.rollback()
         flash(f'Error creating user: {e}', 'danger')
@@ -521,6 +624,15 @@ def delete_user(id):
     return redirect(url_for('admin.index', _anchor='users'))
 
 
+def _dependency_rows(project_name, dependencies):
+    """Insert mappings for a project's dependencies, skipping blanks, duplicates and itself."""
+    return [
+        {'project_name': project_name, 'dependency_name': dep}
+        for dep in dict.fromkeys(dependencies)
+        if dep and dep != project_name
+    ]
+
+
 @admin_bp.route('/dependencies/update', methods=['POST'])
 def update_dependencies():
     """
@@ -538,10 +650,10 @@ def update_dependencies():
         from models.project import ProjectDependency  # local import to avoid circulars at module import time
         ProjectDependency.query.filter_by(project_name=project_name).delete()
 
-        # Insert new ones
-        for dep in dependencies:
-            if dep and dep != project_name:
-                db.session.add(ProjectDependency(project_name=project_name, dependency_name=dep))
+        # Insert new ones (one multi-row INSERT, same transaction as the delete)
+        rows = _dependency_rows(project_name, dependencies)
+        if rows:
+            db.session.bulk_insert_mappings(ProjectDependency, rows)
 
         db.session.commit()
         flash(f'Dependencies updated for {project_name}.', 'success')
@@ -573,9 +685,9 @@ def create_dependencies():
             flash(f'Dependencies already exist for {project_name}. Use Update instead.', 'danger')
             return redirect(url_for('admin.index', _anchor='dependencies'))
 
-        for dep in dependencies:
-            if dep and dep != project_name:
-                db.session.add(ProjectDependency(project_name=project_name, dependency_name=dep))
+        rows = _dependency_rows(project_name, dependencies)
+        if rows:
+            db.session.bulk_insert_mappings(ProjectDependency, rows)
 
         db.session.commit()
         flash(f'Dependencies created for {project_name}.', 'success')
@@ -1,12 +1,100 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from models.user import User
-from extensions import db, limiter, csrf
+from extensions import db, limiter, csrf, get_redis
 from flask_limiter import RateLimitExceeded
 from flask_wtf.csrf import CSRFError
+from sqlalchemy import select, bindparam
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash
+from cachetools import TTLCache
+import threading
 
 auth_bp = Blueprint('auth', __name__)
 
+# Built once so SQLAlchemy reuses its compiled form for every login/register
+_USER_BY_EMAIL = select(User).where(User.email == bindparam('email'))
+
+# Emails recently looked up and not found; absorbs repeated probes for unknown accounts.
+# Kept in Redis when REDIS_URL is set, so creating an account clears the miss for every
+# Gunicorn worker; otherwise per process.
+UNKNOWN_EMAIL_TTL_SECONDS = 60
+_UNKNOWN_EMAILS = TTLCache(maxsize=10_000, ttl=UNKNOWN_EMAIL_TTL_SECONDS)
+_UNKNOWN_EMAILS_LOCK = threading.Lock()
+
+# Checked when no user matches so failed logins take as long as a wrong password
+_DUMMY_PASSWORD_HASH = generate_password_hash('not-a-real-password')
+
+
+# Only company accounts may sign in or register
+_ALLOWED_DOMAIN = '@adventz.com'
+
+
+def _parse_auth_payload():
+    """Return the submitted credentials as a mapping, from a JSON body or the form."""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        return data if isinstance(data, dict) else {}
+    return request.form
+
+
+def _is_allowed_email(email):
+    return bool(email) and email.endswith(_ALLOWED_DOMAIN)
+
+
+def _unknown_email_key(email):
+    return f"auth:unknown:{email}"
+
+
+def _is_known_unknown(email):
+    r = get_redis()
+    if r is None:
+        with _UNKNOWN_EMAILS_LOCK:
+            return email in _UNKNOWN_EMAILS
+    try:
+        return bool(r.exists(_unknown_email_key(email)))
+    except Exception as e:
+        current_app.logger.warning(f"Unknown-email cache lookup failed: {e}")
+        return False
+
+
+def _remember_unknown(email):
+    r = get_redis()
+    if r is None:
+        with _UNKNOWN_EMAILS_LOCK:
+            _UNKNOWN_EMAILS[email] = True
+        return
+    try:
+        r.setex(_unknown_email_key(email), UNKNOWN_EMAIL_TTL_SECONDS, 1)
+    except Exception as e:
+        current_app.logger.warning(f"Unknown-email cache write failed: {e}")
+
+
+def find_user_by_email(email, use_cache=True):
+    """
+    Return the User with this email, or None. Recent misses are answered from the
+    unknown-email cache unless use_cache is False.
+    """
+    if use_cache and _is_known_unknown(email):
+        return None
+    user = db.session.execute(_USER_BY_EMAIL, {'email': email}).scalar_one_or_none()
+    if user is None:
+        _remember_unknown(email)
+    return user
+
+
+def forget_unknown_email(email):
+    """Drop a cached miss once an account with this email has been created."""
+    with _UNKNOWN_EMAILS_LOCK:
+        _UNKNOWN_EMAILS.pop(email, None)
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        r.delete(_unknown_email_key(email))
+    except Exception as e:
+        current_app.logger.warning(f"Unknown-email cache delete failed: {e}")
+
 @auth_bp.errorhandler(RateLimitExceeded)
 def handle_rate_limit_exceeded(e):
     return jsonify({
@@ -32,34 +120,31 @@ def login():
         return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
-        # Get credentials from JSON or Form
-        if request.is_json:
-            data = request.get_json()
-            email = data.get('email')
-            password = data.get('password')
-        else:
-            email = request.form.get('email')
-            password = request.form.get('password')
-            
-        if not email or not email.endswith('@adventz.com'):
+        data = _parse_auth_payload()
+        email = data.get('email')
+        password = data.get('password')
+
+        if not _is_allowed_email(email):
             error_msg = 'Access restricted to @adventz.com emails only.'
             if request.is_json:
                 return jsonify({'success': False, 'message': error_msg})
             flash(error_msg, 'danger')
             return redirect(url_for('main.index'))
                 
-        user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        user = find_user_by_email(email)
+        if user is None:
+            check_password_hash(_DUMMY_PASSWORD_HASH, password or '')
+        elif user.check_password(password):
             login_user(user, remember=request.form.get('remember') == 'on')
             if request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify({'success': True, 'redirect_url': url_for('main.dashboard')})
             return redirect(url_for('main.dashboard'))
-        else:
-            error_msg = 'Invalid email or password.'
-            if request.is_json:
-                return jsonify({'success': False, 'message': error_msg})
-            flash(error_msg, 'danger')
-            return redirect(url_for('main.index'))
+
+        error_msg = 'Invalid email or password.'
+        if request.is_json:
+            return jsonify({'success': False, 'message': error_msg})
+        flash(error_msg, 'danger')
+        return redirect(url_for('main.index'))
             
     # GET request redirects to landing page (where modal exists)
     return redirect(url_for('main.index'))
@@ -68,24 +153,12 @@ def login():
 @limiter.limit("3 per hour")
 @limiter.limit("10 per day")
 def register():
-    email = None
-    password = None
-    confirm_password = None
-    username = None
+    data = _parse_auth_payload()
+    email = data.get('email')
+    password = data.get('password')
+    confirm_password = data.get('confirm_password')
 
-    if request.is_json:
-        data = request.get_json()
-        email = data.get('email')
-        password = data.get('password')
-        confirm_password = data.get('confirm_password')
-        username = data.get('username')
-    else:
-        email = request.form.get('email')
-        password = request.form.get('password')
-        confirm_password = request.form.get('confirm_password')
-        username = request.form.get('username')
-
-    if not email or not email.endswith('@adventz.com'):
+    if not _is_allowed_email(email):
         error_msg = 'Registration restricted to @adventz.com emails only.'
         if request.is_json:
             return jsonify({'success': False, 'message': error_msg})
@@ -99,20 +172,29 @@ def register():
         flash(error_msg, 'danger')
         return redirect(url_for('main.index'))
 
-    # Check if user already exists
-    user = User.query.filter_by(email=email).first()
+    # Check if user already exists (always against the database: a cached miss may be stale)
+    user = find_user_by_email(email, use_cache=False)
+    exists_msg = 'User already exists.'
     if user:
-        error_msg = 'User already exists.'
         if request.is_json:
-            return jsonify({'success': False, 'message': error_msg})
-        flash(error_msg, 'danger')
+            return jsonify({'success': False, 'message': exists_msg})
+        flash(exists_msg, 'danger')
         return redirect(url_for('main.index'))
         
     new_user = User(email=email)
     new_user.set_password(password)
     # If username is needed in model, add it here. Currently User model doesn't have it.
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Registered concurrently; the unique index on user.email rejected the duplicate
+        db.session.rollback()
+        if request.is_json:
+            return jsonify({'success': False, 'message': exists_msg})
+        flash(exists_msg, 'danger')
+        return redirect(url_for('main.index'))
+    forget_unknown_email(email)
     
     success_msg = 'Registration successful. Please log in.'
     if request.is_json:
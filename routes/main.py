@@ -1,74 +1,115 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, session, send_file, redirect, url_for, Response, stream_with_context
+from flask import Blueprint, abort, render_template, request, jsonify, current_app, session, send_file, redirect, url_for, Response, stream_with_context
 from flask_login import login_required, current_user
 from models.project import Project, ProjectMetadata, ProjectDependency
 from models.conversation import Conversation, ChatSession
-from models.audit import AuditLog
-from models.comparison_upload import ComparisonUpload
 from extensions import db, limiter
-from services.qna_service import QnAService
+from sqlalchemy import select, update
+from services.qna_service import get_qna_service
 from utils.security import sanitize_input, validate_file_path, validate_mode, validate_selected_files
 import os
 import io
-import json
+import math
+import orjson
 import secrets
+import shutil
 import tempfile
 import uuid
 import threading
-import time
-import fitz # PyMuPDF
+from concurrent.futures import ThreadPoolExecutor
 import bleach
-from datetime import datetime, timedelta
-from collections import OrderedDict
-import hashlib
+from datetime import datetime
+import cachetools
+import pickle
+import re
+import xxhash
 
 from services.document_storage import get_document_storage
+from services import audit_queue, comparison_uploads, page_renderer, project_cache
 
-class LRUCache:
+class LFUCache:
+    """
+    Thread-safe LFU cache shared by the request threads of a worker. Evicting the
+    least frequently used entry keeps popular questions resident while one-off
+    questions cycle through.
+    """
     def __init__(self, capacity=100):
-        self.cache = OrderedDict()
-        self.capacity = capacity
+        self.cache = cachetools.LFUCache(maxsize=capacity)
+        self._lock = threading.Lock()
     def get(self, key):
-        if key not in self.cache: return None
-        self.cache.move_to_end(key)
-        return self.cache[key]
+        with self._lock:
+            return self.cache.get(key)
     def put(self, key, value):
-        self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
+        with self._lock:
+            self.cache[key] = value
+
+QNA_CACHE = LFUCache(capacity=200)
+
+_QUESTION_SPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_question(question):
+    """
+    Fold differences that cannot change the answer (case, runs of whitespace,
+    trailing ?/./!) so trivially rephrased repeats share a QnA cache entry.
+    """
+    if not question:
+        return question
+    return _QUESTION_SPACE_RE.sub(" ", question).strip().rstrip("?.! ").casefold()
 
-QNA_CACHE = LRUCache(capacity=200)
 
 def get_qna_cache_key(project_name, question, primary_mode, advance_mode, selected_files, chat_history, related_projects, visual_intel):
     """Generates a unique cache key based on all inputs that affect the response."""
-    key_data = {
-        'p': project_name,
-        'q': question,
-        'm': primary_mode,
-        'am': advance_mode,
-        'f': list(selected_files) if selected_files else [],
-        'h': [(str(q), str(a)) for q, a in chat_history] if chat_history else [],
-        'rp': list(related_projects) if related_projects else [],
-        'vi': visual_intel
-    }
-    return hashlib.md5(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+    # Field order is fixed by the tuple, so no key sorting or JSON encoding is needed;
+    # pickle frames each nested sequence, so no separator markers are needed either
+    key_data = (
+        project_name,
+        _normalize_question(question),
+        primary_mode,
+        advance_mode,
+        tuple(selected_files) if selected_files else (),
+        tuple(chat_history) if chat_history else (),
+        tuple(related_projects) if related_projects else (),
+        visual_intel,
+    )
+    return xxhash.xxh3_128_hexdigest(pickle.dumps(key_data, protocol=5))
 
 main_bp = Blueprint('main', __name__)
 
+
+def _sse(event):
+    """Encode one server-sent event; yielded as bytes so Werkzeug need not re-encode it."""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+
+_SSE_CHUNK_PREFIX = b'data: {"type":"chunk","text":'
+_SSE_CHUNK_SUFFIX = b'}\n\n'
+
+
+def _sse_chunk(text):
+    """Encode a text chunk event; only the text itself needs JSON-escaping."""
+    return _SSE_CHUNK_PREFIX + orjson.dumps(text) + _SSE_CHUNK_SUFFIX
+
+# Bounds for ?scale= on /api/visual (1.0 = 72 DPI); keeps a single request from
+# asking MuPDF for an enormous pixmap
+MIN_RENDER_SCALE = 0.25
+MAX_RENDER_SCALE = 4.0
+
+# Background Gemini uploads for comparison mode: reused threads, and at most this
+# many concurrent uploads per worker (the rest wait in the pool's queue)
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='gemini-upload')
+UPLOAD_COPY_CHUNK_SIZE = 1 << 20
+
 def _upload_comparison_to_gemini(upload_id: str, temp_path: str, app):
-    """Background: upload temp file to Gemini and update DB so any worker can resolve upload_id -> gemini_file_id."""
+    """Background: upload temp file to Gemini and record the file id so any worker can resolve upload_id -> gemini_file_id."""
     with app.app_context():
         try:
             api_key = app.config.get("GEMINI_API_KEY")
             if not api_key or not temp_path or not os.path.exists(temp_path):
                 return
-            service = QnAService(api_key=api_key)
+            service = get_qna_service()
             file_id = service.upload_user_file_for_comparison(temp_path)
             if file_id:
-                row = ComparisonUpload.query.filter_by(upload_id=upload_id).first()
-                if row:
-                    row.gemini_file_id = file_id
-                    db.session.commit()
+                if comparison_uploads.complete_upload(upload_id, file_id):
                     debug_logger.info("Comparison upload completed for upload_id=%s -> gemini_file_id=%s", upload_id, file_id)
             try:
                 os.remove(temp_path)
@@ -76,21 +117,108 @@ def _upload_comparison_to_gemini(upload_id: str, temp_path: str, app):
                 pass
         except Exception as e:
             debug_logger.exception("Comparison background upload failed: %s", e)
+        finally:
+            comparison_uploads.signal_finished(upload_id)
 
+
+# First-turn chat titles are generated after the answer has been streamed
+_TITLE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='chat-title')
+
+
+def _generate_title_in_background(session_id: int, question: str, app):
+    """Background: replace a new chat's provisional title with a generated one."""
+    with app.app_context():
+        try:
+            title = get_qna_service().generate_chat_title(question)
+            if not title:
+                return
+            db.session.execute(
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                # Renaming is not activity; keep the session's place in the sidebar
+                .values(title=title[:255], updated_at=ChatSession.updated_at)
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            debug_logger.error(f"Chat title generation failed for session {session_id}: {e}")
+
+
+def _resolve_comparison_file_ids(selected_files):
+    """
+    Map selected files to Gemini file ids: upload:<uuid> entries are resolved through the
+    shared comparison upload store (waiting briefly for uploads still in progress),
+    anything else is passed through. Uploads stay resolvable for follow-up questions.
+    """
+    resolved_file_ids = []
+    for fid in (selected_files or []):
+        if not fid.startswith('upload:'):
+            resolved_file_ids.append(fid)
+            continue
+        upload_id = fid[7:]
+        found, gemini_file_id = comparison_uploads.wait_for_upload(upload_id, current_user.id)
+        if gemini_file_id:
+            resolved_file_ids.append(gemini_file_id)
+        elif not found:
+            debug_logger.warning("comparison: skipping upload_id=%s (not found or user mismatch)", upload_id)
+        else:
+            debug_logger.warning("comparison: upload_id=%s still no gemini_file_id after wait", upload_id)
+    return resolved_file_ids
+
+import atexit
 import logging
+import logging.handlers
+import queue
 import traceback
 
-# Setup distinct file logger for debugging
+
+class _ProcessLocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler whose listener thread is started on first use in each process.
+    Threads do not survive fork(), so with preload_app each Gunicorn worker needs
+    its own listener (and a fresh queue rather than the copy inherited from the master).
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.Queue(-1))
+        self._handlers = handlers
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        atexit.register(self._stop_listener)
+
+    def enqueue(self, record):
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        super().enqueue(record)
+
+    def _start_listener(self):
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.queue = queue.Queue(-1)
+            self._listener = logging.handlers.QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+
+    def _stop_listener(self):
+        # Flush what this process queued; a listener copied from the parent is not ours to stop
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+
+
+# Setup distinct file logger for debugging. Request threads only enqueue records;
+# a listener thread (one per process) writes them to both log files.
 debug_logger = logging.getLogger('debug_logger')
-debug_logger.setLevel(logging.INFO)
-if not debug_logger.handlers:
-    fh = logging.FileHandler('sia_debug.log')
-    fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-    debug_logger.addHandler(fh)
 debug_logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler('debug_errors.log')
-handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-debug_logger.addHandler(handler)
+if not debug_logger.handlers:
+    _log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    _log_files = []
+    for _log_path in ('sia_debug.log', 'debug_errors.log'):
+        _fh = logging.FileHandler(_log_path)
+        _fh.setFormatter(_log_formatter)
+        _log_files.append(_fh)
+    debug_logger.addHandler(_ProcessLocalQueueHandler(_log_files))
 
 @main_bp.app_context_processor
 def inject_recent_chats():
@@ -123,7 +251,7 @@ def dashboard():
 @main_bp.route('/api/project/<project_name>/files')
 @login_required
 def project_files(project_name):
-    project = Project.query.filter_by(name=project_name).first_or_404()
+    project = project_cache.get_project(project_name) or abort(404)
     metadata = ProjectMetadata.query.filter_by(project_id=project.id).all()
     
     files = []
@@ -141,7 +269,7 @@ def project_files(project_name):
 @login_required
 def project_view(project_name):
     # Verify project exists
-    project = Project.query.filter_by(name=project_name).first()
+    project = project_cache.get_project(project_name)
     if not project:
         return "Project not found", 404
         
@@ -152,6 +280,21 @@ def project_view(project_name):
 def dap_3d_view():
     return render_template('dap_3d_view.html')
 
+def _visual_format():
+    """
+    Image format for a rendered PDF page: an explicit ?format=, PNG for ?lossless=1,
+    otherwise WebP when the browser accepts it and JPEG if not (both far smaller and
+    cheaper to encode than PNG for page images).
+    """
+    requested = request.args.get('format', '').lower()
+    if requested in ('png', 'webp'):
+        return requested
+    if requested in ('jpeg', 'jpg'):
+        return 'jpeg'
+    if request.args.get('lossless') == '1':
+        return 'png'
+    return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+
 @main_bp.route('/api/visual')
 @login_required
 @limiter.exempt
@@ -174,36 +317,62 @@ def serve_visual():
 
         storage = get_document_storage()
 
-        # Audit Log for File Access
-        try:
-            log = AuditLog(
-                user_id=current_user.email,
-                action='VIEW_FILE',
-                details=f"Accessed {meta.file_name} (Page {page_num})"
-            )
-            db.session.add(log)
-            db.session.commit()
-        except Exception as e:
-            current_app.logger.error(f"Audit Log Failed: {e}")
+        # Audit Log for File Access (written in the background, off the request path)
+        audit_queue.log_event(
+            current_user.email,
+            'VIEW_FILE',
+            f"Accessed {meta.file_name} (Page {page_num})"
+        )
 
         # Check if it's a PDF or Image. For S3 we may have only a key, so
         # derive the extension from the stored path or filename.
         ext = os.path.splitext(file_path)[1].lower() or os.path.splitext(meta.file_name)[1].lower()
 
         if ext == '.pdf':
-            # Always operate on a local temporary path (works for both local and S3)
-            local_path = storage.ensure_local_path(file_path, project_name=meta.project.name if meta.project else None)
-            if not local_path or not os.path.exists(local_path):
+            # Optional render controls: ?scale= / ?dpr= (resolution), ?tile=x,y,w,h
+            # (page points; only that region is rasterised) and ?format=png|jpeg|webp
+            try:
+                scale_factors = (float(request.args.get('scale', 1.0)), float(request.args.get('dpr', 1.0)))
+                tile = request.args.get('tile')
+                clip = tuple(float(v) for v in tile.split(',')) if tile else None
+            except ValueError:
+                return "Invalid render parameters", 400
+            # float() accepts "nan" and "inf", which would slip through the clamps below
+            if not all(math.isfinite(v) for v in scale_factors + (clip or ())):
+                return "Invalid render parameters", 400
+            if clip is not None and (len(clip) != 4 or clip[2] <= 0 or clip[3] <= 0):
+                return "Invalid render parameters", 400
+            scale = scale_factors[0] * scale_factors[1]
+            scale = min(max(scale, MIN_RENDER_SCALE), MAX_RENDER_SCALE)
+            fmt = _visual_format()
+
+            project_name = meta.project.name if meta.project else None
+            version = storage.version_tag(file_path, project_name=project_name)
+            if version is None:
                 return "File not found", 404
 
-            doc = fitz.open(local_path)
-            if page_num < 0 or page_num >= len(doc):
-                 return "Page out of range", 404
-                 
-            page = doc[page_num]
-            pix = page.get_pixmap()
-            img_data = pix.tobytes("png")
-            return send_file(io.BytesIO(img_data), mimetype='image/png')
+            # The ETag comes from cheap metadata, so a browser revalidating a page it
+            # already has gets a 304 without the PDF being opened or rendered
+            etag = xxhash.xxh3_64_hexdigest(pickle.dumps((file_path, version, page_num, scale, clip, fmt), protocol=5))
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                # Rendered pages and open documents are cached per process (works for both local and S3)
+                try:
+                    img_data = page_renderer.render_page(
+                        storage, file_path, page_num, project_name=project_name,
+                        scale=scale, clip=clip, fmt=fmt, version=version,
+                    )
+                except IndexError:
+                    return "Page out of range", 404
+                if img_data is None:
+                    return "File not found", 404
+                response = send_file(io.BytesIO(img_data), mimetype=f'image/{fmt}', conditional=False)
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.max_age = 3600
+            response.vary.add('Accept')
+            return response
 
         elif ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
             # For images, we just serve the file itself if page_num is 0
@@ -242,7 +411,7 @@ def serve_visual():
 @login_required
 @limiter.exempt
 def get_sessions(project_name):
-    project = Project.query.filter_by(name=project_name).first_or_404()
+    project = project_cache.get_project(project_name) or abort(404)
     sessions = ChatSession.query.filter_by(user_id=current_user.id, project_id=project.id)\
         .order_by(ChatSession.is_pinned.desc(), ChatSession.updated_at.desc()).all()
     
@@ -253,6 +422,43 @@ def get_sessions(project_name):
         'is_pinned': s.is_pinned
     } for s in sessions])
 
+def _load_chat_history(session_id):
+    """
+    A session's (question, answer) pairs in order, as one tuple of plain tuples: passed
+    unchanged to the QnA service and hashed directly into the QnA cache key.
+    """
+    rows = db.session.execute(
+        select(Conversation.question, Conversation.answer)
+        .where(Conversation.session_id == session_id)
+        .order_by(Conversation.timestamp.asc())
+    )
+    return tuple((question, answer) for question, answer in rows)
+
+def _session_messages(session_id):
+    """
+    Serialise a session's messages for the chat UI. Selects only the columns the
+    payload needs (no ORM objects, no identity map) and fetches them in batches.
+    """
+    rows = db.session.execute(
+        select(
+            Conversation.id, Conversation.question, Conversation.answer,
+            Conversation.timestamp, Conversation.is_pinned,
+            Conversation.relevant_files, Conversation.visuals,
+        )
+        .where(Conversation.session_id == session_id)
+        .order_by(Conversation.timestamp.asc())
+        .execution_options(yield_per=500)
+    )
+    return [{
+        'id': m.id,
+        'question': m.question,
+        'answer': m.answer,
+        'timestamp': m.timestamp.isoformat(),
+        'is_pinned': m.is_pinned,
+        'relevant_files': m.relevant_files or [],
+        'visuals': m.visuals or []
+    } for m in rows]
+
 @main_bp.route('/api/chat/session/<int:session_id>')
 @login_required
 def get_session_messages(session_id):
@@ -260,22 +466,25 @@ def get_session_messages(session_id):
     if session_obj.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    messages = Conversation.query.filter_by(session_id=session_id)\
-        .order_by(Conversation.timestamp.asc()).all()
-    
     return jsonify({
         'session_title': session_obj.title,
-        'messages': [{
-            'id': m.id,
-            'question': m.question,
-            'answer': m.answer,
-            'timestamp': m.timestamp.isoformat(),
-            'is_pinned': m.is_pinned,
-            'relevant_files': json.loads(m.relevant_files) if isinstance(m.relevant_files, str) else (m.relevant_files or []),
-            'visuals': json.loads(m.visuals) if isinstance(m.visuals, str) else (m.visuals or [])
-        } for m in messages]
+        'messages': _session_messages(session_obj.id)
     })
 
+@main_bp.route('/api/chat/session/<int:session_id>/title', methods=['GET'])
+@login_required
+@limiter.exempt
+def get_session_title(session_id):
+    """Just the session's title; polled by the chat page until a new chat's generated title is saved."""
+    row = db.session.execute(
+        select(ChatSession.title, ChatSession.user_id).where(ChatSession.id == session_id)
+    ).first()
+    if row is None:
+        abort(404)
+    if row.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'title': row.title})
+
 @main_bp.route('/api/chat/session/<int:session_id>/title', methods=['POST'])
 @login_required
 def update_session_title(session_id):
@@ -322,19 +531,9 @@ def get_shared_session(token):
     session_obj = ChatSession.query.filter_by(share_token=token).first()
     if not session_obj:
         return jsonify({'error': 'Not found'}), 404
-    messages = Conversation.query.filter_by(session_id=session_obj.id)\
-        .order_by(Conversation.timestamp.asc()).all()
     return jsonify({
         'session_title': session_obj.title,
-        'messages': [{
-            'id': m.id,
-            'question': m.question,
-            'answer': m.answer,
-            'timestamp': m.timestamp.isoformat(),
-            'is_pinned': m.is_pinned,
-            'relevant_files': json.loads(m.relevant_files) if isinstance(m.relevant_files, str) else (m.relevant_files or []),
-            'visuals': json.loads(m.visuals) if isinstance(m.visuals, str) else (m.visuals or [])
-        } for m in messages]
+        'messages': _session_messages(session_obj.id)
     })
 
 
@@ -351,41 +550,21 @@ def shared_chat_view(token):
 @login_required
 def upload_comparison(project_name):
     """Accept one file; return upload_id immediately. Previous flow (upload to Gemini) continues in background."""
-    Project.query.filter_by(name=project_name).first_or_404()
+    project_cache.get_project(project_name) or abort(404)
     file = request.files.get('file')
-    content_length = request.content_length or 0
     if not file or not file.filename:
         return jsonify({'error': 'No file provided'}), 400
     allowed = ('.pdf', '.doc', '.docx', '.txt')
     if not file.filename.lower().endswith(allowed):
         return jsonify({'error': 'Allowed types: PDF, DOC, DOCX, TXT'}), 400
-    # Enforce a 50 MB maximum upload size for comparison files
-    max_bytes = 50 * 1024 * 1024
-    if content_length > max_bytes:
-        return jsonify({'error': 'File is too large. Maximum allowed size is 50 MB.'}), 400
     fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(file.filename)[1])
     try:
-        os.close(fd)
-        file.save(temp_path)
-        # Remove old comparison uploads for this user (older than 24h) so the table does not grow indefinitely
-        try:
-            cutoff = datetime.utcnow() - timedelta(hours=24)
-            ComparisonUpload.query.filter(
-                ComparisonUpload.user_id == current_user.id,
-                ComparisonUpload.created_at < cutoff,
-            ).delete(synchronize_session=False)
-        except Exception:
-            pass
+        # Copy straight into the already-open descriptor in 1 MB chunks
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_COPY_CHUNK_SIZE)
         upload_id = str(uuid.uuid4())
-        row = ComparisonUpload(upload_id=upload_id, user_id=current_user.id, gemini_file_id=None)
-        db.session.add(row)
-        db.session.commit()
-        thread = threading.Thread(
-            target=_upload_comparison_to_gemini,
-            args=(upload_id, temp_path, current_app._get_current_object()),
-            daemon=True,
-        )
-        thread.start()
+        comparison_uploads.register_upload(upload_id, current_user.id)
+        _UPLOAD_POOL.submit(_upload_comparison_to_gemini, upload_id, temp_path, current_app._get_current_object())
         return jsonify({"upload_id": upload_id})
     except Exception as e:
         db.session.rollback()
@@ -418,7 +597,7 @@ def cross_project_check(project_name):
     if not api_key:
         return jsonify({'error': 'Gemini API Key not configured'}), 500
 
-    proj = Project.query.filter_by(name=project_name).first_or_404()
+    proj = project_cache.get_project(project_name) or abort(404)
     deps = ProjectDependency.query.filter_by(project_name=proj.name).all()
     related_names = [d.dependency_name for d in deps]
 
@@ -426,7 +605,7 @@ def cross_project_check(project_name):
     parent_has_hits = False
 
     try:
-        service = QnAService(api_key=api_key)
+        service = get_qna_service()
         parent_files = service.get_relevant_files(question, project_name, max_files=3)
         parent_has_hits = len(parent_files) > 0
         for rel_name in related_names:
@@ -493,7 +672,7 @@ def chat_api(project_name):
         if not api_key:
              return jsonify({'error': 'Gemini API Key not configured'}), 500
 
-        proj = Project.query.filter_by(name=project_name).first_or_404()
+        proj = project_cache.get_project(project_name) or abort(404)
         
         # Handle Session
         if session_id:
@@ -501,18 +680,15 @@ def chat_api(project_name):
             if not chat_session or chat_session.user_id != current_user.id:
                 return jsonify({'error': 'Invalid session'}), 403
         else:
+            # Built detached so no pre-model query autoflushes it; added and inserted
+            # together with the first message by the end-of-turn commit
             chat_session = ChatSession(user_id=current_user.id, project_id=proj.id)
-            db.session.add(chat_session)
-            db.session.flush() # Get ID without committing yet
 
         try:
-            service = QnAService(api_key=api_key)
-            
-            # Fetch history for this session and convert to (question, answer) pairs
-            history_msgs = Conversation.query.filter_by(session_id=chat_session.id)\
-                .order_by(Conversation.timestamp.asc()).all()
+            service = get_qna_service()
             
-            chat_history = [(m.question, m.answer) for m in history_msgs]
+            # Fetch history for this session as (question, answer) pairs (a new session has none)
+            chat_history = _load_chat_history(chat_session.id) if session_id else ()
 
             # Determine related projects if cross‑project mode is enabled
             # When include_related is False (or not set), use single-project; when True, use related_projects_to_include or all from DB
@@ -539,43 +715,10 @@ def chat_api(project_name):
                     debug_logger.info(
                         "chat_api(comparison): entering comparison branch | project=%s | session_id=%s | selected_files=%s",
                         project_name,
-                        chat_session.id,
+                        session_id or 'new',
                         selected_files,
                     )
-                    # Resolve upload:uuid to Gemini file_id (DB-backed so any worker can resolve).
-                    # Rows are kept so the same uploaded file can be reused for follow-up questions in this conversation.
-                    resolved_file_ids = []
-                    for fid in (selected_files or []):
-                        if fid.startswith("upload:"):
-                            upload_id = fid[7:]
-                            row = ComparisonUpload.query.filter_by(
-                                upload_id=upload_id, user_id=current_user.id
-                            ).first()
-                            if not row:
-                                debug_logger.warning(
-                                    "chat_api(comparison): skipping upload_id=%s (not found or user mismatch)",
-                                    upload_id,
-                                )
-                                continue
-                            if row.gemini_file_id:
-                                resolved_file_ids.append(row.gemini_file_id)
-                                continue
-                            # Background may still be uploading; poll DB (up to ~7.5 s)
-                            for _ in range(15):
-                                row = ComparisonUpload.query.filter_by(
-                                    upload_id=upload_id, user_id=current_user.id
-                                ).first()
-                                if row and row.gemini_file_id:
-                                    resolved_file_ids.append(row.gemini_file_id)
-                                    break
-                                time.sleep(0.5)
-                            else:
-                                debug_logger.warning(
-                                    "chat_api(comparison): upload_id=%s still no gemini_file_id after wait",
-                                    upload_id,
-                                )
-                        else:
-                            resolved_file_ids.append(fid)
+                    resolved_file_ids = _resolve_comparison_file_ids(selected_files)
                     debug_logger.info(
                         "chat_api(comparison): resolved_file_ids=%s (count=%d)",
                         resolved_file_ids,
@@ -621,22 +764,9 @@ def chat_api(project_name):
             files = result.get('relevant_files', [])
             visuals = result.get('visuals', [])
             
-            debug_logger.info(f"chat_api: Saving visuals={visuals}")
-            # Save message to DB
-            conv = Conversation(
-                session_id=chat_session.id,
-                project_id=proj.id,
-                user_id=current_user.id,
-                question=question,
-                answer=answer,
-            relevant_files=json.dumps(files),
-            visuals=json.dumps(visuals)
-            )
-            db.session.add(conv)
-            chat_session.updated_at = datetime.utcnow()
-            
-            # Auto-generate title if it's the first message (Gemini or full question fallback; DB max 255)
-            if not history_msgs:
+            # Auto-generate title if it's the first message (Gemini or full question fallback; DB max 255),
+            # before the session is re-attached so no connection is held through the title call
+            if not chat_history:
                 try:
                     generated_title = service.generate_chat_title(question)
                     if generated_title:
@@ -647,16 +777,29 @@ def chat_api(project_name):
                     current_app.logger.error(f"Title Generation Error: {title_err}")
                     chat_session.title = question[:255]
 
-            # Audit Log for Query
-            log = AuditLog(
-                user_id=current_user.email,
-                action='QUERY',
-                details=f"Project: {project_name} | Session: {chat_session.id} | Mode: {style_mode} | AdvanceMode: {advance_mode} | Q: {question[:100]}..."
+            debug_logger.info(f"chat_api: Saving visuals={visuals}")
+            # Save message to DB; re-attach the session row (a new one is inserted here)
+            db.session.add(chat_session)
+            conv = Conversation(
+                session=chat_session,
+                project_id=proj.id,
+                user_id=current_user.id,
+                question=question,
+                answer=answer,
+            relevant_files=files,
+            visuals=visuals
             )
-            db.session.add(log)
-            
+            db.session.add(conv)
+            chat_session.updated_at = datetime.utcnow()
             db.session.commit()
 
+            # Audit Log for Query (written in the background, off the request path)
+            audit_queue.log_event(
+                current_user.email,
+                'QUERY',
+                f"Project: {project_name} | Session: {chat_session.id} | Mode: {style_mode} | AdvanceMode: {advance_mode} | Q: {question[:100]}..."
+            )
+
             return jsonify({
                 'answer': answer,
                 'files': files,
@@ -674,8 +817,45 @@ def chat_api(project_name):
         return jsonify({'error': str(e)}), 500
 
 
-def _chat_stream_events(project_name, question, primary_mode, advance_mode, selected_files, session_id, service, chat_session, history_msgs, chat_history, proj, related_projects, visual_intel=True):
-    """Generator that yields SSE event strings (data: {...}\\n\\n). Saves to DB on 'done' and adds session_id/session_title."""
+def _persist_turn(chat_session, proj, project_name, question, answer, result, primary_mode, chat_history):
+    """
+    Save one streamed turn: the Conversation row, the session's updated_at and title
+    (or, for a new chat, the session row itself) go out in a single commit; nothing
+    is committed if any part fails. The QUERY audit event is queued once the turn is saved.
+    A new chat is saved under its question and renamed in the background, so the
+    title call never delays the 'done' event.
+    """
+    try:
+        # Re-attach the session row released before the model call (a new one is inserted here)
+        db.session.add(chat_session)
+        conv = Conversation(
+            session=chat_session,
+            project_id=proj.id,
+            user_id=current_user.id,
+            question=question,
+            answer=answer,
+            relevant_files=result.get('relevant_files', []),
+            visuals=result.get('visuals', [])
+        )
+        db.session.add(conv)
+        chat_session.updated_at = datetime.utcnow()
+        if not chat_history:
+            chat_session.title = question[:255]
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        debug_logger.error(f"Chat stream: failed to save turn for session {chat_session.id}: {e}")
+        raise
+    if not chat_history:
+        _TITLE_POOL.submit(_generate_title_in_background, chat_session.id, question, current_app._get_current_object())
+    audit_queue.log_event(current_user.email, 'QUERY', f"Project: {project_name} | Session: {chat_session.id} | Mode: {primary_mode} | Q: {question[:100]}...", streaming=True)
+
+
+def _chat_stream_events(project_name, question, primary_mode, advance_mode, selected_files, session_id, service, chat_session, chat_history, proj, related_projects, visual_intel=True):
+    """Generator that yields encoded SSE events (data: {...}\\n\\n). Saves to DB on 'done' and adds session_id/session_title."""
+    # Give the request's connection back to the pool while the model generates;
+    # _persist_turn re-attaches chat_session and checks one out again to save the turn
+    db.session.close()
     try:
         cache_key = get_qna_cache_key(project_name, question, primary_mode, advance_mode, selected_files, chat_history, related_projects, visual_intel)
         cached_result = QNA_CACHE.get(cache_key)
@@ -683,54 +863,15 @@ def _chat_stream_events(project_name, question, primary_mode, advance_mode, sele
         if cached_result:
             debug_logger.info(f"QnA Cache HIT for chat_stream_api: {cache_key}")
             answer = cached_result.get('answer', '')
-            yield f"data: {json.dumps({'type': 'chunk', 'text': answer})}\n\n"
-            conv = Conversation(
-                session_id=chat_session.id, 
-                project_id=proj.id, 
-                user_id=current_user.id, 
-                question=question, 
-                answer=answer, 
-                relevant_files=json.dumps(cached_result.get('relevant_files', [])), 
-                visuals=json.dumps(cached_result.get('visuals', []))
-            )
-            db.session.add(conv)
-            chat_session.updated_at = datetime.utcnow()
-            if not history_msgs:
-                try:
-                    gt = service.generate_chat_title(question)
-                    chat_session.title = (gt[:255] if gt else question[:255])
-                except Exception:
-                    chat_session.title = question[:255]
-            db.session.add(AuditLog(user_id=current_user.email, action='QUERY', details=f"Project: {project_name} | Session: {chat_session.id} | Mode: {primary_mode} | Q: {question[:100]}..."))
-            db.session.commit()
-            yield f"data: {json.dumps({'type': 'done', 'answer': answer, 'relevant_files': cached_result.get('relevant_files', []), 'visuals': cached_result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})}\n\n"
+            yield _sse_chunk(answer)
+            _persist_turn(chat_session, proj, project_name, question, answer, cached_result, primary_mode, chat_history)
+            yield _sse({'type': 'done', 'answer': answer, 'relevant_files': cached_result.get('relevant_files', []), 'visuals': cached_result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})
             return
             
         debug_logger.info(f"QnA Cache MISS for chat_stream_api: {cache_key}")
 
         if advance_mode == 'comparison':
-            resolved_file_ids = []
-            for fid in (selected_files or []):
-                if fid.startswith('upload:'):
-                    upload_id = fid[7:]
-                    row = ComparisonUpload.query.filter_by(
-                        upload_id=upload_id, user_id=current_user.id
-                    ).first()
-                    if not row:
-                        continue
-                    if row.gemini_file_id:
-                        resolved_file_ids.append(row.gemini_file_id)
-                        continue
-                    for _ in range(15):
-                        row = ComparisonUpload.query.filter_by(
-                            upload_id=upload_id, user_id=current_user.id
-                        ).first()
-                        if row and row.gemini_file_id:
-                            resolved_file_ids.append(row.gemini_file_id)
-                            break
-                        time.sleep(0.5)
-                else:
-                    resolved_file_ids.append(fid)
+            resolved_file_ids = _resolve_comparison_file_ids(selected_files)
             result = service.generate_comparison_answer(
                 question=question,
                 project_name=project_name,
@@ -742,28 +883,10 @@ def _chat_stream_events(project_name, question, primary_mode, advance_mode, sele
             if 'answer' in result:
                 QNA_CACHE.put(cache_key, result)
             answer = result.get('answer', '')
-            yield f"data: {json.dumps({'type': 'chunk', 'text': answer})}\n\n"
+            yield _sse_chunk(answer)
             # Save to DB before sending done (so session_title can be set)
-            conv = Conversation(
-                session_id=chat_session.id, 
-                project_id=proj.id, 
-                user_id=current_user.id, 
-                question=question, 
-                answer=answer, 
-                relevant_files=json.dumps(result.get('relevant_files', [])), 
-                visuals=json.dumps(result.get('visuals', []))
-            )
-            db.session.add(conv)
-            chat_session.updated_at = datetime.utcnow()
-            if not history_msgs:
-                try:
-                    gt = service.generate_chat_title(question)
-                    chat_session.title = (gt[:255] if gt else question[:255])
-                except Exception:
-                    chat_session.title = question[:255]
-            db.session.add(AuditLog(user_id=current_user.email, action='QUERY', details=f"Project: {project_name} | Session: {chat_session.id} | Mode: {primary_mode} | Q: {question[:100]}..."))
-            db.session.commit()
-            yield f"data: {json.dumps({'type': 'done', 'answer': answer, 'relevant_files': result.get('relevant_files', []), 'visuals': result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})}\n\n"
+            _persist_turn(chat_session, proj, project_name, question, answer, result, primary_mode, chat_history)
+            yield _sse({'type': 'done', 'answer': answer, 'relevant_files': result.get('relevant_files', []), 'visuals': result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})
         elif advance_mode == 'cross_project' and related_projects:
             result = service.generate_cross_project_answer(
                 question=question,
@@ -775,27 +898,9 @@ def _chat_stream_events(project_name, question, primary_mode, advance_mode, sele
             if 'answer' in result:
                 QNA_CACHE.put(cache_key, result)
             answer = result.get('answer', '')
-            yield f"data: {json.dumps({'type': 'chunk', 'text': answer})}\n\n"
-            conv = Conversation(
-                session_id=chat_session.id, 
-                project_id=proj.id, 
-                user_id=current_user.id, 
-                question=question, 
-                answer=answer, 
-                relevant_files=json.dumps(result.get('relevant_files', [])), 
-                visuals=json.dumps(result.get('visuals', []))
-            )
-            db.session.add(conv)
-            chat_session.updated_at = datetime.utcnow()
-            if not history_msgs:
-                try:
-                    gt = service.generate_chat_title(question)
-                    chat_session.title = (gt[:255] if gt else question[:255])
-                except Exception:
-                    chat_session.title = question[:255]
-            db.session.add(AuditLog(user_id=current_user.email, action='QUERY', details=f"Project: {project_name} | Session: {chat_session.id} | Mode: {primary_mode} | Q: {question[:100]}..."))
-            db.session.commit()
-            yield f"data: {json.dumps({'type': 'done', 'answer': answer, 'relevant_files': result.get('relevant_files', []), 'visuals': result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})}\n\n"
+            yield _sse_chunk(answer)
+            _persist_turn(chat_session, proj, project_name, question, answer, result, primary_mode, chat_history)
+            yield _sse({'type': 'done', 'answer': answer, 'relevant_files': result.get('relevant_files', []), 'visuals': result.get('visuals', []), 'session_id': chat_session.id, 'session_title': chat_session.title})
         else:
             done_ev = None
             for ev in service.generate_single_project_answer_stream(
@@ -806,7 +911,7 @@ def _chat_stream_events(project_name, question, primary_mode, advance_mode, sele
                 extract_visuals=visual_intel
             ):
                 if ev.get('type') == 'chunk':
-                    yield f"data: {json.dumps(ev)}\n\n"
+                    yield _sse_chunk(ev.get('text', ''))
                 else:
                     done_ev = ev
                     break
@@ -817,32 +922,14 @@ def _chat_stream_events(project_name, question, primary_mode, advance_mode, sele
             debug_logger.info(f"stream: Saving done_ev={done_ev}")
             answer = done_ev.get('answer', '')
             debug_logger.info(f"DEBUG: creating Conversation with visuals={done_ev.get('visuals')}")
-            conv = Conversation(
-                session_id=chat_session.id, 
-                project_id=proj.id, 
-                user_id=current_user.id, 
-                question=question, 
-                answer=answer, 
-                relevant_files=json.dumps(done_ev.get('relevant_files', [])), 
-                visuals=json.dumps(done_ev.get('visuals', []))
-            )
-            db.session.add(conv)
-            chat_session.updated_at = datetime.utcnow()
-            if not history_msgs:
-                try:
-                    gt = service.generate_chat_title(question)
-                    chat_session.title = (gt[:255] if gt else question[:255])
-                except Exception:
-                    chat_session.title = question[:255]
-            db.session.add(AuditLog(user_id=current_user.email, action='QUERY', details=f"Project: {project_name} | Session: {chat_session.id} | Mode: {primary_mode} | Q: {question[:100]}..."))
-            db.session.commit()
+            _persist_turn(chat_session, proj, project_name, question, answer, done_ev, primary_mode, chat_history)
             done_ev['session_id'] = chat_session.id
             done_ev['session_title'] = chat_session.title
-            yield f"data: {json.dumps(done_ev)}\n\n"
+            yield _sse(done_ev)
     except Exception as e:
         debug_logger.error(f"Chat stream error: {e}")
         debug_logger.error(traceback.format_exc())
-        yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+        yield _sse({'type': 'error', 'message': str(e)})
 
 
 @main_bp.route('/api/chat/<project_name>/stream', methods=['POST'])
@@ -888,18 +975,17 @@ def chat_stream_api(project_name):
     if not api_key:
         return jsonify({'error': 'Gemini API Key not configured'}), 500
 
-    proj = Project.query.filter_by(name=project_name).first_or_404()
+    proj = project_cache.get_project(project_name) or abort(404)
     if session_id:
         chat_session = ChatSession.query.get(session_id)
         if not chat_session or chat_session.user_id != current_user.id:
             return jsonify({'error': 'Invalid session'}), 403
     else:
+        # Built detached so the ProjectDependency read below can't autoflush it;
+        # _persist_turn inserts it together with the first message
         chat_session = ChatSession(user_id=current_user.id, project_id=proj.id)
-        db.session.add(chat_session)
-        db.session.flush()
 
-    history_msgs = Conversation.query.filter_by(session_id=chat_session.id).order_by(Conversation.timestamp.asc()).all()
-    chat_history = [(m.question, m.answer) for m in history_msgs]
+    chat_history = _load_chat_history(chat_session.id) if session_id else ()
     related_projects = []
     if advance_mode == 'cross_project':
         deps = ProjectDependency.query.filter_by(project_name=proj.name).all()
@@ -908,15 +994,17 @@ def chat_stream_api(project_name):
             related_projects = list(related_projects_to_include) if isinstance(related_projects_to_include, list) and related_projects_to_include else all_related
             related_projects = [p for p in related_projects if p in all_related]
 
-    service = QnAService(api_key=api_key)
+    service = get_qna_service()
 
     return Response(
         stream_with_context(_chat_stream_events(
             project_name, question, style_mode, advance_mode, selected_files, session_id,
-            service, chat_session, history_msgs, chat_history, proj, related_projects, visual_intel
+            service, chat_session, chat_history, proj, related_projects, visual_intel
         )),
         content_type='text/event-stream',
-        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        # Events are already encoded bytes; hand them to the server untouched
+        direct_passthrough=True,
     )
 
 
@@ -0,0 +1,139 @@
+"""
+Background writer for AuditLog rows.
+
+Request handlers enqueue audit events with log_event() and return immediately;
+a daemon thread per worker process drains the queue and writes the rows in
+batches (one INSERT + COMMIT per batch) outside the request path.
+
+With AUDIT_LOG_ASYNC disabled the events are written synchronously instead,
+but still batched: everything logged during a request goes out in one INSERT
+and one COMMIT once the response is ready.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from flask import after_this_request, current_app, g, has_request_context
+
+from extensions import db
+from models.audit import AuditLog
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL_SECONDS = 1.0
+MAX_PENDING_EVENTS = 10000
+
+_queue: "queue.Queue[dict]" = queue.Queue(maxsize=MAX_PENDING_EVENTS)
+_lock = threading.Lock()
+_worker: Optional[threading.Thread] = None
+_worker_pid: Optional[int] = None
+_app = None
+
+
+def log_event(user_id: Optional[str], action: str, details: Optional[str], streaming: bool = False) -> None:
+    """
+    Queue an audit event; it is written to the database shortly afterwards.
+    Pass streaming=True from inside a streamed response body, where after-request
+    hooks have already run (only matters when AUDIT_LOG_ASYNC is off).
+    """
+    event = {
+        'user_id': user_id,
+        'action': action,
+        'details': details,
+        'timestamp': datetime.utcnow(),
+    }
+    if not current_app.config.get('AUDIT_LOG_ASYNC', True):
+        if has_request_context() and not streaming:
+            _defer_to_end_of_request(event)
+        else:
+            _write_now(current_app._get_current_object(), [event])
+        return
+
+    _ensure_worker(current_app._get_current_object())
+    try:
+        _queue.put_nowait(event)
+    except queue.Full:
+        logging.error(f"Audit queue full; dropping audit event {action} for {user_id}")
+
+
+def _defer_to_end_of_request(event: dict) -> None:
+    pending = g.get('_audit_events')
+    if pending is None:
+        pending = g._audit_events = []
+
+        @after_this_request
+        def _flush_request_events(response):
+            _write_now(current_app._get_current_object(), g.pop('_audit_events', []))
+            return response
+
+    pending.append(event)
+
+
+def _write_now(app, batch: List[dict]) -> None:
+    # Own connection and transaction, so the view's session state is neither committed nor disturbed
+    if not batch:
+        return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(AuditLog.__table__.insert(), batch)
+    except Exception as e:
+        app.logger.error(f"Audit Log Failed ({len(batch)} events): {e}")
+
+
+def _ensure_worker(app) -> None:
+    global _worker, _worker_pid, _app
+    # Threads do not survive fork(), so each Gunicorn worker starts its own writer
+    if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+        return
+    with _lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        _app = app
+        _worker_pid = os.getpid()
+        _worker = threading.Thread(target=_run, name='audit-log-writer', daemon=True)
+        _worker.start()
+
+
+def _run() -> None:
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL_SECONDS
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write(batch)
+
+
+def _write(batch: List[dict]) -> None:
+    if not batch or _app is None:
+        return
+    with _app.app_context():
+        try:
+            db.session.bulk_insert_mappings(AuditLog, batch)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            _app.logger.error(f"Audit Log Failed ({len(batch)} events): {e}")
+        finally:
+            db.session.remove()
+
+
+@atexit.register
+def _flush_pending() -> None:
+    """Write whatever is still queued when the process exits."""
+    batch = []
+    while True:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    _write(batch)
@@ -0,0 +1,140 @@
+"""
+Shared store for comparison-mode uploads (upload_id -> gemini_file_id) so any
+Gunicorn worker can resolve an upload started on another one.
+
+Uses a Redis hash per upload (with a TTL for automatic cleanup) when REDIS_URL
+is configured, and falls back to the comparison_upload MySQL table otherwise.
+
+Requests served by the worker that accepted the upload wait on a threading.Event
+set by the background upload, so they wake as soon as it finishes; other workers
+fall back to polling the shared store.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select
+
+from extensions import db, get_redis
+from models.comparison_upload import ComparisonUpload
+
+# Uploads stay resolvable for follow-up questions in the same conversation
+UPLOAD_TTL = timedelta(hours=24)
+
+
+# How long a question waits for a still-running background upload
+UPLOAD_WAIT_SECONDS = 7.5
+POLL_INTERVAL_SECONDS = 0.5
+
+# upload_id -> Event set when this process's background upload for it finishes
+_ready_events: Dict[str, threading.Event] = {}
+_ready_lock = threading.Lock()
+
+
+def _redis_key(upload_id: str) -> str:
+    return f"cmp:{upload_id}"
+
+
+def register_upload(upload_id: str, user_id: int) -> None:
+    """Record a new (still uploading) comparison file for this user."""
+    with _ready_lock:
+        _ready_events[upload_id] = threading.Event()
+
+    r = get_redis()
+    if r is not None:
+        pipe = r.pipeline()
+        pipe.hset(_redis_key(upload_id), mapping={'user_id': user_id})
+        pipe.expire(_redis_key(upload_id), UPLOAD_TTL)
+        pipe.execute()
+        return
+
+    # Remove old comparison uploads for this user so the table does not grow indefinitely
+    try:
+        cutoff = datetime.utcnow() - UPLOAD_TTL
+        ComparisonUpload.query.filter(
+            ComparisonUpload.user_id == user_id,
+            ComparisonUpload.created_at < cutoff,
+        ).delete(synchronize_session=False)
+    except Exception:
+        pass
+    db.session.add(ComparisonUpload(upload_id=upload_id, user_id=user_id, gemini_file_id=None))
+    db.session.commit()
+
+
+def complete_upload(upload_id: str, gemini_file_id: str) -> bool:
+    """Attach the Gemini file id once the background upload finishes."""
+    r = get_redis()
+    if r is not None:
+        key = _redis_key(upload_id)
+        if not r.exists(key):
+            return False
+        r.hset(key, 'gemini_file_id', gemini_file_id)
+        return True
+
+    row = ComparisonUpload.query.filter_by(upload_id=upload_id).first()
+    if not row:
+        return False
+    row.gemini_file_id = gemini_file_id
+    db.session.commit()
+    return True
+
+
+def get_upload(upload_id: str, user_id: int) -> Tuple[bool, Optional[str]]:
+    """
+    Look up an upload owned by user_id.
+    Returns (found, gemini_file_id); gemini_file_id is None while the upload is still running.
+    """
+    r = get_redis()
+    if r is not None:
+        owner, gemini_file_id = r.hmget(_redis_key(upload_id), 'user_id', 'gemini_file_id')
+        if owner is None or owner != str(user_id):
+            return False, None
+        return True, gemini_file_id or None
+
+    # Read on a separate connection so repeated polls get a fresh snapshot
+    # (and the caller's pending session state is left alone)
+    with db.engine.connect() as conn:
+        row = conn.execute(
+            select(ComparisonUpload.gemini_file_id).where(
+                ComparisonUpload.upload_id == upload_id,
+                ComparisonUpload.user_id == user_id,
+            )
+        ).first()
+    if not row:
+        return False, None
+    return True, row.gemini_file_id
+
+
+def signal_finished(upload_id: str) -> None:
+    """Wake local waiters once the background upload has finished (successfully or not)."""
+    with _ready_lock:
+        event = _ready_events.pop(upload_id, None)
+    if event is not None:
+        event.set()
+
+
+def wait_for_upload(upload_id: str, user_id: int, timeout: float = UPLOAD_WAIT_SECONDS) -> Tuple[bool, Optional[str]]:
+    """
+    Like get_upload, but if the upload is still running wait up to `timeout` seconds
+    for its gemini_file_id. Returns (found, gemini_file_id).
+    """
+    found, gemini_file_id = get_upload(upload_id, user_id)
+    if not found or gemini_file_id:
+        return found, gemini_file_id
+
+    with _ready_lock:
+        event = _ready_events.get(upload_id)
+    if event is not None:
+        # Uploading in this process: sleep until it is done, not in fixed steps
+        event.wait(timeout)
+        return get_upload(upload_id, user_id)
+
+    # Uploading in another worker: poll the shared store
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL_SECONDS)
+        found, gemini_file_id = get_upload(upload_id, user_id)
+        if gemini_file_id:
+            break
+    return found, gemini_file_id
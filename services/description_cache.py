@@ -0,0 +1,73 @@
+"""
+Cache of AI-generated document descriptions keyed by the PDF's SHA-256, so
+uploading the same document again does not pay for another Gemini call.
+
+Entries live in a small per-process TTL cache and, when REDIS_URL is
+configured, in Redis so every Gunicorn worker shares them.
+"""
+import hashlib
+import threading
+from typing import Optional
+
+from cachetools import TTLCache
+from flask import current_app
+
+from extensions import get_redis
+
+DESCRIPTION_TTL_SECONDS = 86400
+HASH_CHUNK_SIZE = 64 * 1024
+
+_LOCAL_CACHE = TTLCache(maxsize=1024, ttl=DESCRIPTION_TTL_SECONDS)
+_LOCAL_CACHE_LOCK = threading.Lock()
+
+
+def content_digest(file_storage) -> str:
+    """SHA-256 of an uploaded file, read in chunks; the stream is rewound afterwards."""
+    stream = getattr(file_storage, 'stream', None) or file_storage
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def _key(digest: str, max_words: int) -> str:
+    return f"gemini:desc:{digest}:{max_words}"
+
+
+def get_description(digest: str, max_words: int) -> Optional[str]:
+    """Return a cached description for this document, or None."""
+    key = _key(digest, max_words)
+    with _LOCAL_CACHE_LOCK:
+        description = _LOCAL_CACHE.get(key)
+    if description is not None:
+        return description
+
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        description = r.get(key)
+    except Exception as e:
+        current_app.logger.warning(f"Description cache lookup failed: {e}")
+        return None
+    if description is not None:
+        with _LOCAL_CACHE_LOCK:
+            _LOCAL_CACHE[key] = description
+    return description
+
+
+def store_description(digest: str, max_words: int, description: str) -> None:
+    """Remember a generated description for this document."""
+    key = _key(digest, max_words)
+    with _LOCAL_CACHE_LOCK:
+        _LOCAL_CACHE[key] = description
+
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        r.setex(key, DESCRIPTION_TTL_SECONDS, description)
+    except Exception as e:
+        current_app.logger.warning(f"Description cache write failed: {e}")
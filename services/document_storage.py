@@ -1,80 +1,388 @@
+import functools
 import os
+import shutil
 import tempfile
-from typing import Optional
+import threading
+from abc import ABC, abstractmethod
+from typing import List, Optional
+from urllib.parse import quote
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import BotoCoreError, ClientError
-from flask import current_app
+from flask import current_app, g, has_request_context
 
+from utils.uploads import spooled_upload_path
 
-class DocumentStorage:
+# S3 DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+
+# Large objects are uploaded and fetched as parallel 8 MB parts
+_S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# Request threads and multipart transfer threads share the client's connection pool;
+# botocore's default of 10 connections would make them queue for a socket
+S3_MAX_POOL_CONNECTIONS = max(64, (os.cpu_count() or 1) * 8)
+
+# Mode of stored documents, whichever way they were written. Spooled uploads are
+# created 0600 by tempfile, so hard-linked files are widened to this (nginx serves
+# them via X-Accel-Redirect as a different user).
+STORED_FILE_MODE = 0o644
+
+# S3 clients are thread-safe and expensive to build (endpoint data, signers, a fresh
+# connection pool), so one per credential set is shared by every request in the process
+_S3_CLIENTS = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+
+
+def _local_stat(path: str) -> Optional[os.stat_result]:
     """
-    Abstraction over project document storage.
-    - Local mode: uses PROJECT_DOCS_DIR on the filesystem.
-    - S3 mode: uses an S3 bucket; the stored identifier is the S3 object key.
+    os.stat(path), or None if the file does not exist. Inside a request the result is
+    remembered on flask.g, so resolving and versioning the same document costs one stat.
     """
+    stats = g.setdefault("_storage_stats", {}) if has_request_context() else None
+    if stats is not None and path in stats:
+        return stats[path]
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if stats is not None:
+        stats[path] = st
+    return st
 
-    def __init__(self) -> None:
-        # current_app must be available whenever methods are called
-        if not current_app:
-            raise RuntimeError("DocumentStorage requires an active Flask application context.")
 
-    @property
-    def _config(self):
-        return current_app.config
+def _forget_local_stat(path: str) -> None:
+    """Drop a remembered stat after the file at `path` was written or removed."""
+    if has_request_context():
+        stats = g.get("_storage_stats")
+        if stats:
+            stats.pop(path, None)
 
-    @property
-    def use_s3(self) -> bool:
-        return bool(self._config.get("USE_S3_FOR_PROJECT_DOCS"))
 
-    # ---------- S3 helpers ----------
+def _absolute(path: str) -> str:
+    # Stored paths are already absolute and normalised; skip the string work for those
+    if os.path.isabs(path) and ".." not in path:
+        return path
+    return os.path.normpath(os.path.abspath(path))
 
-    def _get_s3_client(self):
-        """
-        Build an S3 client. Explicit credentials are optional; if not provided,
-        boto3 will fall back to its default credential chain (env/IAM, etc.).
-        """
-        aws_access_key_id = self._config.get("AWS_ACCESS_KEY_ID")
-        aws_secret_access_key = self._config.get("AWS_SECRET_ACCESS_KEY")
-        region_name = self._config.get("AWS_REGION")
 
-        session = boto3.session.Session(
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name=region_name,
-        )
-        return session.client("s3")
+@functools.lru_cache(maxsize=8192)
+def _local_storage_id(base_dir: str, project_name: str, filename: str) -> str:
+    return _absolute(os.path.join(base_dir, project_name, filename))
 
-    def _build_s3_key(self, project_name: str, filename: str) -> str:
-        prefix = (self._config.get("S3_PROJECT_DOCS_PREFIX") or "").strip("/")
-        parts = [p for p in [prefix, project_name, filename] if p]
-        return "/".join(parts)
 
+@functools.lru_cache(maxsize=8192)
+def _s3_key(prefix: str, project_name: str, filename: str) -> str:
+    parts = [p for p in [prefix.strip("/"), project_name, filename] if p]
+    return "/".join(parts)
+
+
+class DocumentStorage(ABC):
+    """
+    Abstraction over project document storage. Use get_document_storage(), which
+    returns the backend selected by USE_S3_FOR_PROJECT_DOCS:
+    - LocalDocumentStorage: uses PROJECT_DOCS_DIR on the filesystem.
+    - S3DocumentStorage: uses an S3 bucket; the stored identifier is the S3 object key.
+    The backend and its settings are fixed when the instance is created, so methods
+    neither read the app config nor branch on the mode.
+    """
+
+    use_s3 = False
+
+    @staticmethod
+    def _rewind(file_storage):
+        """Return the upload's underlying stream, positioned at the start."""
+        stream = getattr(file_storage, "stream", None) or file_storage
+        try:
+            stream.seek(0)
+        except Exception:
+            pass
+        return stream
+
+    @abstractmethod
     def build_storage_id(self, project_name: str, filename: str) -> str:
         """
         Compute the storage identifier for a document without writing it.
         - Local mode: absolute filesystem path under PROJECT_DOCS_DIR.
         - S3 mode: S3 object key.
         """
-        if not self.use_s3:
-            base_dir = self._config.get("PROJECT_DOCS_DIR")
-            if not base_dir:
-                raise RuntimeError("PROJECT_DOCS_DIR is not configured.")
-            return os.path.normpath(
-                os.path.abspath(os.path.join(base_dir, project_name, filename))
-            )
-
-        return self._build_s3_key(project_name, filename)
 
+    @abstractmethod
     def exists(self, storage_id: str) -> bool:
         """Return True if the given storage identifier exists."""
+
+    @abstractmethod
+    def save_pdf(self, project_name: str, filename: str, file_storage) -> str:
+        """
+        Save an uploaded PDF for a project.
+        Returns a storage identifier:
+          - local mode: absolute filesystem path
+          - S3 mode: S3 object key
+        """
+
+    @abstractmethod
+    def save_pdf_exclusive(self, project_name: str, filename: str, file_storage) -> str:
+        """
+        Like save_pdf, but never overwrites: the existence check and the write are a
+        single atomic operation (O_EXCL / hard link locally, If-None-Match: * on S3).
+        Raises FileExistsError if a document with that name is already stored.
+        """
+
+    @abstractmethod
+    def delete(self, storage_id: Optional[str]) -> None:
+        """Delete a stored document, if it exists."""
+
+    @abstractmethod
+    def delete_many(self, storage_ids: List[str]) -> None:
+        """Delete several stored documents; S3 keys are removed in batches of up to 1000 per request."""
+
+    def presigned_url(self, storage_id: str, download_name: Optional[str] = None,
+                      expires_in: int = 300) -> Optional[str]:
+        """
+        S3 mode only: a short-lived GET URL so clients download directly from S3.
+        Returns None in local mode or when the URL cannot be generated.
+        """
+        return None
+
+    @abstractmethod
+    def read_bytes(self, storage_id: str) -> Optional[bytes]:
+        """
+        Read the full contents of a stored document into memory.
+        Returns bytes or None if not found.
+        """
+
+    @abstractmethod
+    def version_tag(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        """
+        A cheap identifier that changes whenever the stored document changes, for cache keys:
+        mtime and size locally (one stat), the ETag on S3 (one HEAD request).
+        Returns None if the document does not exist.
+        """
+
+    def open_stream(self, storage_id: str):
+        """
+        S3 mode only: open a stored document for streaming without reading it into memory.
+        Returns (body, content_length), where body is a botocore StreamingBody the caller
+        must close, or (None, None) if the object cannot be read.
+        """
+        return None, None
+
+    @abstractmethod
+    def ensure_local_path(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        """
+        For components that require a filesystem path (e.g. PyMuPDF, Gemini uploads):
+        - Local mode: returns the existing path if it exists.
+        - S3 mode: downloads the object to a temporary file and returns that path.
+        """
+
+
+class LocalDocumentStorage(DocumentStorage):
+    """Documents stored under PROJECT_DOCS_DIR; the storage identifier is the absolute path."""
+
+    def __init__(self, config) -> None:
+        self._base_dir = config.get("PROJECT_DOCS_DIR")
+
+    def build_storage_id(self, project_name: str, filename: str) -> str:
+        if not self._base_dir:
+            raise RuntimeError("PROJECT_DOCS_DIR is not configured.")
+        return _local_storage_id(self._base_dir, project_name, filename)
+
+    def exists(self, storage_id: str) -> bool:
         if not storage_id:
             return False
+        return _local_stat(storage_id) is not None
+
+    def save_pdf(self, project_name: str, filename: str, file_storage) -> str:
+        if not filename:
+            raise ValueError("Filename is required for document storage.")
+
+        storage_id = self.build_storage_id(project_name, filename)
+        # Ensure local directory exists
+        os.makedirs(os.path.dirname(storage_id), exist_ok=True)
+        if not self._link_spooled_upload(file_storage, storage_id):
+            file_storage.save(storage_id)
+        _forget_local_stat(storage_id)
+        return storage_id
+
+    def save_pdf_exclusive(self, project_name: str, filename: str, file_storage) -> str:
+        if not filename:
+            raise ValueError("Filename is required for document storage.")
+
+        storage_id = self.build_storage_id(project_name, filename)
+        os.makedirs(os.path.dirname(storage_id), exist_ok=True)
+        # os.link fails with FileExistsError instead of replacing the target
+        source = spooled_upload_path(file_storage)
+        linked = False
+        if source:
+            try:
+                os.link(source, storage_id)
+                linked = True
+            except FileExistsError:
+                raise
+            except OSError:
+                # Different filesystem etc.: copy instead
+                pass
+        if linked:
+            try:
+                os.chmod(storage_id, STORED_FILE_MODE)
+            except OSError:
+                os.remove(storage_id)
+                raise
+            _forget_local_stat(storage_id)
+            return storage_id
+
+        fd = os.open(storage_id, os.O_WRONLY | os.O_CREAT | os.O_EXCL, STORED_FILE_MODE)
+        stream = self._rewind(file_storage)
+        try:
+            with os.fdopen(fd, "wb") as dest:
+                shutil.copyfileobj(stream, dest)
+        except BaseException:
+            try:
+                os.remove(storage_id)
+            except OSError:
+                pass
+            raise
+        _forget_local_stat(storage_id)
+        return storage_id
+
+    @staticmethod
+    def _link_spooled_upload(file_storage, destination: str) -> bool:
+        """
+        Hard-link an upload that the request already spooled to disk into place,
+        avoiding a second full copy. Returns False when that is not possible
+        (in-memory upload, different filesystem, ...) so the caller copies instead.
+        """
+        source = spooled_upload_path(file_storage)
+        if not source:
+            return False
+        staging = f"{destination}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            os.link(source, staging)
+            os.chmod(staging, STORED_FILE_MODE)
+            os.replace(staging, destination)
+            return True
+        except OSError:
+            try:
+                os.remove(staging)
+            except OSError:
+                pass
+            return False
+
+    def delete(self, storage_id: Optional[str]) -> None:
+        if not storage_id:
+            return
+        try:
+            os.remove(storage_id)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            current_app.logger.error(f"Failed to remove local document {storage_id}: {e}")
+        _forget_local_stat(storage_id)
 
-        if not self.use_s3:
-            return os.path.exists(storage_id)
+    def delete_many(self, storage_ids: List[str]) -> None:
+        for storage_id in storage_ids:
+            self.delete(storage_id)
 
-        bucket = self._config.get("S3_PROJECT_DOCS_BUCKET")
+    def read_bytes(self, storage_id: str) -> Optional[bytes]:
+        if not storage_id:
+            return None
+        # Open directly rather than stat first: one syscall fewer, and no race with a delete
+        try:
+            with open(storage_id, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            current_app.logger.error(f"Failed to read local document {storage_id}: {e}")
+            return None
+
+    def version_tag(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        if not storage_id:
+            return None
+        local_path = self.ensure_local_path(storage_id, project_name=project_name)
+        st = _local_stat(local_path) if local_path else None
+        if st is None:
+            return None
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+    def ensure_local_path(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        if not storage_id:
+            return None
+
+        # Normalise, then optionally try a project-based fallback similar to existing behaviour.
+        normalized = _absolute(storage_id)
+        if _local_stat(normalized) is not None:
+            return normalized
+
+        if self._base_dir and project_name:
+            fallback = _absolute(os.path.join(self._base_dir, project_name, os.path.basename(storage_id)))
+            if _local_stat(fallback) is not None:
+                return fallback
+        return None
+
+
+class S3DocumentStorage(DocumentStorage):
+    """Documents stored in S3_PROJECT_DOCS_BUCKET; the storage identifier is the object key."""
+
+    use_s3 = True
+
+    def __init__(self, config) -> None:
+        self._bucket = config.get("S3_PROJECT_DOCS_BUCKET")
+        self._prefix = config.get("S3_PROJECT_DOCS_PREFIX") or ""
+        self._credentials = (
+            config.get("AWS_ACCESS_KEY_ID"),
+            config.get("AWS_SECRET_ACCESS_KEY"),
+            config.get("AWS_REGION"),
+        )
+
+    def _get_s3_client(self):
+        """
+        Return the process-wide S3 client for the configured credentials and region,
+        building it on first use. Explicit credentials are optional; if not provided,
+        boto3 will fall back to its default credential chain (env/IAM, etc.).
+        """
+        client = _S3_CLIENTS.get(self._credentials)
+        if client is not None:
+            return client
+
+        with _S3_CLIENTS_LOCK:
+            client = _S3_CLIENTS.get(self._credentials)
+            if client is None:
+                aws_access_key_id, aws_secret_access_key, region_name = self._credentials
+                session = boto3.session.Session(
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                    region_name=region_name,
+                )
+                client = session.client(
+                    "s3",
+                    config=BotoConfig(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": 3, "mode": "adaptive"},
+                    ),
+                )
+                _S3_CLIENTS[self._credentials] = client
+        return client
+
+    def _build_s3_key(self, project_name: str, filename: str) -> str:
+        return _s3_key(self._prefix, project_name, filename)
+
+    def build_storage_id(self, project_name: str, filename: str) -> str:
+        return self._build_s3_key(project_name, filename)
+
+    def exists(self, storage_id: str) -> bool:
+        if not storage_id:
+            return False
+
+        bucket = self._bucket
         if not bucket:
             return False
 
@@ -91,65 +399,59 @@ class DocumentStorage:
             )
             return False
 
-    # ---------- Public API ----------
-
     def save_pdf(self, project_name: str, filename: str, file_storage) -> str:
-        """
-        Save an uploaded PDF for a project.
-        Returns a storage identifier:
-          - local mode: absolute filesystem path
-          - S3 mode: S3 object key
-        """
         if not filename:
             raise ValueError("Filename is required for document storage.")
 
-        storage_id = self.build_storage_id(project_name, filename)
-
-        if not self.use_s3:
-            # Ensure local directory exists
-            save_dir = os.path.dirname(storage_id)
-            os.makedirs(save_dir, exist_ok=True)
-            file_storage.save(storage_id)
-            return storage_id
-
-        # S3 mode
-        bucket = self._config.get("S3_PROJECT_DOCS_BUCKET")
+        bucket = self._bucket
         if not bucket:
             raise RuntimeError("S3_PROJECT_DOCS_BUCKET must be configured when USE_S3_FOR_PROJECT_DOCS is enabled.")
 
-        key = storage_id
+        key = self.build_storage_id(project_name, filename)
         client = self._get_s3_client()
-
-        # Ensure stream is at beginning
-        stream = getattr(file_storage, "stream", None) or file_storage
+        stream = self._rewind(file_storage)
         try:
-            stream.seek(0)
-        except Exception:
-            pass
+            client.upload_fileobj(
+                stream, bucket, key,
+                ExtraArgs={"ContentType": "application/pdf"},
+                Config=_S3_TRANSFER_CONFIG,
+            )
+        except (BotoCoreError, ClientError) as e:
+            current_app.logger.error(f"Failed to upload document to S3 (bucket={bucket}, key={key}): {e}")
+            raise
+
+        return key
 
+    def save_pdf_exclusive(self, project_name: str, filename: str, file_storage) -> str:
+        if not filename:
+            raise ValueError("Filename is required for document storage.")
+
+        bucket = self._bucket
+        if not bucket:
+            raise RuntimeError("S3_PROJECT_DOCS_BUCKET must be configured when USE_S3_FOR_PROJECT_DOCS is enabled.")
+
+        key = self.build_storage_id(project_name, filename)
+        client = self._get_s3_client()
+        stream = self._rewind(file_storage)
         try:
-            client.upload_fileobj(stream, bucket, key)
-        except (BotoCoreError, ClientError) as e:
+            client.put_object(Bucket=bucket, Key=key, Body=stream, IfNoneMatch="*")
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code in ("PreconditionFailed", "412", "ConditionalRequestConflict"):
+                raise FileExistsError(key) from e
+            current_app.logger.error(f"Failed to upload document to S3 (bucket={bucket}, key={key}): {e}")
+            raise
+        except BotoCoreError as e:
             current_app.logger.error(f"Failed to upload document to S3 (bucket={bucket}, key={key}): {e}")
             raise
 
         return key
 
     def delete(self, storage_id: Optional[str]) -> None:
-        """Delete a stored document, if it exists."""
         if not storage_id:
             return
 
-        if not self.use_s3:
-            try:
-                if os.path.exists(storage_id):
-                    os.remove(storage_id)
-            except OSError as e:
-                current_app.logger.error(f"Failed to remove local document {storage_id}: {e}")
-            return
-
-        # S3 mode
-        bucket = self._config.get("S3_PROJECT_DOCS_BUCKET")
+        bucket = self._bucket
         if not bucket:
             current_app.logger.error("S3_PROJECT_DOCS_BUCKET is not configured; cannot delete document from S3.")
             return
@@ -160,26 +462,55 @@ class DocumentStorage:
         except (BotoCoreError, ClientError) as e:
             current_app.logger.error(f"Failed to delete document from S3 (bucket={bucket}, key={storage_id}): {e}")
 
+    def delete_many(self, storage_ids: List[str]) -> None:
+        storage_ids = [sid for sid in storage_ids if sid]
+        if not storage_ids:
+            return
+
+        bucket = self._bucket
+        if not bucket:
+            current_app.logger.error("S3_PROJECT_DOCS_BUCKET is not configured; cannot delete documents from S3.")
+            return
+
+        client = self._get_s3_client()
+        for start in range(0, len(storage_ids), S3_DELETE_BATCH_SIZE):
+            batch = storage_ids[start:start + S3_DELETE_BATCH_SIZE]
+            try:
+                response = client.delete_objects(
+                    Bucket=bucket,
+                    # Quiet: the response lists only failures, not every deleted key
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+                )
+                for error in response.get("Errors", []):
+                    current_app.logger.error(
+                        f"Failed to delete document from S3 (bucket={bucket}, key={error.get('Key')}): {error.get('Message')}"
+                    )
+            except (BotoCoreError, ClientError) as e:
+                current_app.logger.error(f"Failed to batch-delete {len(batch)} documents from S3 (bucket={bucket}): {e}")
+
+    def presigned_url(self, storage_id: str, download_name: Optional[str] = None,
+                      expires_in: int = 300) -> Optional[str]:
+        bucket = self._bucket
+        if not storage_id or not bucket:
+            return None
+
+        params = {"Bucket": bucket, "Key": storage_id}
+        if download_name:
+            params["ResponseContentDisposition"] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+            params["ResponseContentType"] = "application/pdf"
+
+        client = self._get_s3_client()
+        try:
+            return client.generate_presigned_url("get_object", Params=params, ExpiresIn=expires_in)
+        except (BotoCoreError, ClientError) as e:
+            current_app.logger.error(f"Failed to presign S3 URL (bucket={bucket}, key={storage_id}): {e}")
+            return None
+
     def read_bytes(self, storage_id: str) -> Optional[bytes]:
-        """
-        Read the full contents of a stored document into memory.
-        Returns bytes or None if not found.
-        """
         if not storage_id:
             return None
 
-        if not self.use_s3:
-            try:
-                if not os.path.exists(storage_id):
-                    return None
-                with open(storage_id, "rb") as f:
-                    return f.read()
-            except OSError as e:
-                current_app.logger.error(f"Failed to read local document {storage_id}: {e}")
-                return None
-
-        # S3 mode
-        bucket = self._config.get("S3_PROJECT_DOCS_BUCKET")
+        bucket = self._bucket
         if not bucket:
             current_app.logger.error("S3_PROJECT_DOCS_BUCKET is not configured; cannot read document from S3.")
             return None
@@ -192,47 +523,78 @@ class DocumentStorage:
             current_app.logger.error(f"Failed to read document from S3 (bucket={bucket}, key={storage_id}): {e}")
             return None
 
-    def ensure_local_path(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
-        """
-        For components that require a filesystem path (e.g. PyMuPDF, Gemini uploads):
-        - Local mode: returns the existing path if it exists.
-        - S3 mode: downloads the object to a temporary file and returns that path.
-        """
-        if not storage_id:
+    def version_tag(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        bucket = self._bucket
+        if not storage_id or not bucket:
             return None
 
-        if not self.use_s3:
-            # Normalise, then optionally try a project-based fallback similar to existing behaviour.
-            normalized = os.path.normpath(os.path.abspath(storage_id))
-            if os.path.exists(normalized):
-                return normalized
+        client = self._get_s3_client()
+        try:
+            return client.head_object(Bucket=bucket, Key=storage_id).get("ETag")
+        except (BotoCoreError, ClientError) as e:
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if error_code not in ("404", "NoSuchKey", "NotFound"):
+                current_app.logger.error(f"Failed to stat S3 object (bucket={bucket}, key={storage_id}): {e}")
+            return None
+
+    def open_stream(self, storage_id: str):
+        if not storage_id:
+            return None, None
 
-            base_dir = self._config.get("PROJECT_DOCS_DIR")
-            if base_dir and project_name:
-                fallback = os.path.join(base_dir, project_name, os.path.basename(storage_id))
-                fallback = os.path.normpath(os.path.abspath(fallback))
-                if os.path.exists(fallback):
-                    return fallback
+        bucket = self._bucket
+        if not bucket:
+            current_app.logger.error("S3_PROJECT_DOCS_BUCKET is not configured; cannot read document from S3.")
+            return None, None
+
+        client = self._get_s3_client()
+        try:
+            obj = client.get_object(Bucket=bucket, Key=storage_id)
+            return obj["Body"], obj.get("ContentLength")
+        except (BotoCoreError, ClientError) as e:
+            current_app.logger.error(f"Failed to read document from S3 (bucket={bucket}, key={storage_id}): {e}")
+            return None, None
+
+    def ensure_local_path(self, storage_id: str, project_name: Optional[str] = None) -> Optional[str]:
+        if not storage_id:
             return None
 
-        # S3 mode: download to a temporary file
-        data = self.read_bytes(storage_id)
-        if data is None:
+        # Stream the object straight into a temporary file
+        bucket = self._bucket
+        if not bucket:
+            current_app.logger.error("S3_PROJECT_DOCS_BUCKET is not configured; cannot read document from S3.")
             return None
 
         # Derive extension from storage_id (best-effort)
         _, ext = os.path.splitext(storage_id)
         try:
             fd, temp_path = tempfile.mkstemp(suffix=ext or ".bin")
-            with os.fdopen(fd, "wb") as tmp:
-                tmp.write(data)
-            return temp_path
         except OSError as e:
             current_app.logger.error(f"Failed to create temp file for document {storage_id}: {e}")
             return None
 
+        client = self._get_s3_client()
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                client.download_fileobj(bucket, storage_id, tmp, Config=_S3_TRANSFER_CONFIG)
+            return temp_path
+        except (BotoCoreError, ClientError, OSError) as e:
+            current_app.logger.error(f"Failed to download document from S3 (bucket={bucket}, key={storage_id}): {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+
 
 def get_document_storage() -> DocumentStorage:
-    """Convenience helper to obtain a storage instance."""
-    return DocumentStorage()
-
+    """
+    Return the app's document storage backend, created on first use in each worker.
+    USE_S3_FOR_PROJECT_DOCS and the related settings are read once, at that point.
+    """
+    app = current_app._get_current_object()
+    storage = app.extensions.get('document_storage')
+    if storage is None:
+        backend = S3DocumentStorage if app.config.get("USE_S3_FOR_PROJECT_DOCS") else LocalDocumentStorage
+        storage = backend(app.config)
+        app.extensions['document_storage'] = storage
+    return storage
@@ -1,20 +1,30 @@
 import os
 import io
+import inspect
 import time
 import logging
+import ast
 import json
+import orjson
+import numpy as np
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 from google import genai
 from google.genai import types
+from cachetools import TTLCache
 from models.project import Project, ProjectMetadata, FileUploadCache
 from extensions import db
 import tempfile
 from utils.image_processing import process_image_for_ocr
-from flask import current_app
+from flask import current_app, g, has_app_context, has_request_context
 
 from services.document_storage import get_document_storage
+from services import project_cache
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 
 try:
     from config import Config
@@ -32,12 +42,95 @@ ROUTING_MAX_OUTPUT_TOKENS = 9000
 ANSWER_MAX_OUTPUT_TOKENS = 9000
 VISUAL_PAGES_MAX_OUTPUT_TOKENS = 300
 
+# How long an uploaded file may take to become ACTIVE; read here rather than from
+# current_app because uploads run on pool threads without an app context
+FILE_ACTIVE_TIMEOUT_SECONDS = float(getattr(Config, "GEMINI_FILE_ACTIVE_TIMEOUT", 15))
+
+# Process-local copy of FileUploadCache hits: (project_id, local_path) -> gemini_file_id.
+# Only hits are cached; entries are overwritten whenever this process saves a new upload,
+# and the TTL bounds how long an id replaced by another worker can linger.
+_UPLOAD_ID_CACHE = TTLCache(maxsize=4096, ttl=3600)
+_UPLOAD_ID_CACHE_LOCK = threading.Lock()
+
+# Routing-prompt metadata listing per project: project_id -> (metadata_version, text).
+# Rebuilt only when a metadata row is added, edited or deleted.
+_METADATA_TEXT_CACHE: Dict[int, Tuple[Optional[int], str]] = {}
+_METADATA_TEXT_CACHE_LOCK = threading.Lock()
+METADATA_TEXT_MAX_CHARS = 30000
+
+# Optional local file routing: cosine similarity between the question and each metadata
+# row's "type_of_data | file_name" embedding, instead of a Gemini routing prompt.
+# project_id -> (metadata_version, file names, unit-normalised float32 matrix)
+USE_EMBEDDING_ROUTER = bool(getattr(Config, "USE_EMBEDDING_ROUTER", False))
+EMBEDDING_MODEL = getattr(Config, "GEMINI_EMBEDDING_MODEL", None) or "text-embedding-004"
+EMBED_BATCH_SIZE = 100
+_METADATA_EMBEDDING_CACHE: Dict[int, Tuple[Optional[int], List[str], np.ndarray]] = {}
+_METADATA_EMBEDDING_CACHE_LOCK = threading.Lock()
+
+# Shared by every request in the process: uploads and ACTIVE polling are network-bound,
+# so a question's attachments are sent side by side instead of one after another
+_FILE_UPLOAD_POOL = ThreadPoolExecutor(max_workers=4 * MAX_ATTACHMENTS, thread_name_prefix="gemini-file")
+
+
+# Markdown code fences around a model reply, and the first [...] block inside one
+_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.IGNORECASE)
+_ARRAY_RE = re.compile(r'\[.*?\]', re.DOTALL)
+# HTML line breaks the models sometimes emit in plain-text answers and titles
+_BR_RE = re.compile(r"<br\s*/?>")
+_WHITESPACE_RE = re.compile(r"\s+")
+_INT_RE = re.compile(r"\d+")
+
+
+def _parse_json_list(text: str) -> Optional[list]:
+    """
+    Parse a model reply that should be a JSON array (optionally fenced or wrapped in
+    prose). Returns the list, or None if no array can be read from it.
+    """
+    text = _FENCE_RE.sub("", text.strip())
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        match = _ARRAY_RE.search(text)
+        if not match:
+            return None
+        try:
+            parsed = json.loads(match.group(0))
+        except ValueError:
+            try:
+                # Python-style lists, e.g. single-quoted strings
+                parsed = ast.literal_eval(match.group(0))
+            except (ValueError, SyntaxError):
+                return None
+    return parsed if isinstance(parsed, list) else None
+
+
+def _release_db_connection() -> None:
+    """
+    End this context's transaction so its pooled connection is returned before a
+    Gemini call. Rows already loaded stay readable (detached); anything the caller
+    changes afterwards has to be added to the session again before committing.
+    """
+    db.session.close()
+
+
+def _warn_if_db_connection_held(call: str) -> None:
+    """Log when a Gemini call starts while this context still has a DB connection checked out."""
+    if has_app_context() and db.session.in_transaction():
+        debug_logger.warning(
+            "%s started inside an open DB transaction | pool checked out=%s",
+            call,
+            db.engine.pool.checkedout(),
+        )
+
 
 class GeminiService:
     def __init__(self, api_key: str):
         if not api_key:
             raise ValueError("API Key for Gemini is required.")
         self.client = genai.Client(api_key=api_key)
+        # Newer google-genai releases take files.upload(file=...), older ones files.upload(path=...)
+        upload_params = inspect.signature(self.client.files.upload).parameters
+        self._upload_kwarg = "file" if "file" in upload_params else "path"
         # Define model hierarchy (Primary -> Fallback)
         self.routing_models = ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-3-flash-preview"]
         self.answer_models = ["gemini-2.5-pro", "gemini-2.0-flash", "gemini-3-pro-preview"]
@@ -51,7 +144,22 @@ class GeminiService:
         - Normalizes the path (handles slashes, relative vs absolute)
         - If file not found at normalized path, tries fallback: PROJECT_DOCS_DIR/project_name/basename(file_path)
         - Returns (None, False) if file cannot be found at either location
+        Inside a request, successful resolutions are remembered on flask.g, so a document
+        used by several steps of one answer is only stat'ed (or downloaded from S3) once.
         """
+        resolved_paths = g.setdefault("_resolved_file_paths", {}) if has_request_context() else None
+        key = (file_path, project_name)
+        if resolved_paths is not None:
+            resolved = resolved_paths.get(key)
+            if resolved and os.path.exists(resolved):
+                return resolved, True
+
+        resolved, found = self._resolve_file_path_uncached(file_path, project_name)
+        if found and resolved_paths is not None:
+            resolved_paths[key] = resolved
+        return resolved, found
+
+    def _resolve_file_path_uncached(self, file_path: str, project_name: str) -> Tuple[Optional[str], bool]:
         logging.debug(f"[DEBUG] _resolve_file_path called: file_path='{file_path}', project_name='{project_name}'")
 
         if not file_path:
@@ -102,63 +210,110 @@ class GeminiService:
         return None, False
 
     def _get_project_id(self, process_name: str) -> Optional[int]:
-        """Get project ID from process name."""
-        project = Project.query.filter_by(name=process_name).first()
+        """Get project ID from process name (served from the shared project cache)."""
+        project = project_cache.get_project(process_name)
         return project.id if project else None
 
-    def _load_upload_cache(self, process_name: str, local_path: Optional[str] = None) -> Dict[str, str]:
+    def _load_upload_cache_bulk(self, process_name: str, keys: List[str]) -> Dict[str, str]:
         """
-        Load upload cache from database for a project.
-        If local_path is provided, returns only that entry; otherwise returns all entries for the project.
-        Returns dict mapping local_path -> gemini_file_id.
+        Look up several upload cache entries for a project at once: process-local hits
+        first, then one SELECT ... WHERE local_path IN (...) for the rest.
+        Returns dict mapping local_path -> gemini_file_id for the keys that are cached.
         """
+        keys = [k for k in dict.fromkeys(keys) if k]
+        if not keys:
+            return {}
         project_id = self._get_project_id(process_name)
         if not project_id:
             return {}
-        
+
+        result: Dict[str, str] = {}
+        with _UPLOAD_ID_CACHE_LOCK:
+            for key in keys:
+                cached_id = _UPLOAD_ID_CACHE.get((project_id, key))
+                if cached_id:
+                    result[key] = cached_id
+        missing = [k for k in keys if k not in result]
+        if not missing:
+            return result
+
         try:
-            query = FileUploadCache.query.filter_by(project_id=project_id)
-            if local_path:
-                query = query.filter_by(local_path=local_path)
-            
-            cache_entries = query.all()
-            return {entry.local_path: entry.gemini_file_id for entry in cache_entries}
+            rows = db.session.query(FileUploadCache.local_path, FileUploadCache.gemini_file_id).filter(
+                FileUploadCache.project_id == project_id,
+                FileUploadCache.local_path.in_(missing),
+            ).all()
         except Exception as e:
             logging.warning(f"Error loading upload cache from DB: {e}")
-            return {}
+            return result
+
+        with _UPLOAD_ID_CACHE_LOCK:
+            for local_path, gemini_file_id in rows:
+                result[local_path] = gemini_file_id
+                _UPLOAD_ID_CACHE[(project_id, local_path)] = gemini_file_id
+        return result
 
     def _save_upload_cache(self, process_name: str, local_path: str, gemini_file_id: str) -> None:
         """
         Save or update upload cache entry in database.
         Uses upsert: updates if exists, creates if not.
         """
+        self._save_upload_cache_many(process_name, {local_path: gemini_file_id})
+
+    def _save_upload_cache_many(self, process_name: str, entries: Dict[str, str]) -> None:
+        """Upsert several local_path -> gemini_file_id cache entries for a project in one commit."""
         project_id = self._get_project_id(process_name)
         if not project_id:
             logging.error(f"Project {process_name} not found for cache save")
             return
-        
+
         try:
-            cache_entry = FileUploadCache.query.filter_by(
-                project_id=project_id,
-                local_path=local_path
-            ).first()
-            
-            if cache_entry:
-                # Update existing entry
-                cache_entry.gemini_file_id = gemini_file_id
-                cache_entry.updated_at = datetime.utcnow()
+            now = datetime.utcnow()
+            if db.engine.dialect.name == "mysql":
+                # One multi-row INSERT ... ON DUPLICATE KEY UPDATE on uq_project_local_path
+                stmt = mysql_insert(FileUploadCache.__table__).values([
+                    {
+                        "project_id": project_id,
+                        "local_path": local_path,
+                        "gemini_file_id": gemini_file_id,
+                        "updated_at": now,
+                    }
+                    for local_path, gemini_file_id in entries.items()
+                ])
+                db.session.execute(stmt.on_duplicate_key_update(
+                    gemini_file_id=stmt.inserted.gemini_file_id,
+                    updated_at=stmt.inserted.updated_at,
+                ))
             else:
-                # Create new entry
-                cache_entry = FileUploadCache(
-                    project_id=project_id,
-                    local_path=local_path,
-                    gemini_file_id=gemini_file_id
-                )
-                db.session.add(cache_entry)
-            
+                existing = {
+                    entry.local_path: entry
+                    for entry in FileUploadCache.query.filter(
+                        FileUploadCache.project_id == project_id,
+                        FileUploadCache.local_path.in_(list(entries)),
+                    )
+                }
+                for local_path, gemini_file_id in entries.items():
+                    cache_entry = existing.get(local_path)
+                    if cache_entry:
+                        # Update existing entry
+                        cache_entry.gemini_file_id = gemini_file_id
+                        cache_entry.updated_at = now
+                    else:
+                        # Create new entry
+                        db.session.add(FileUploadCache(
+                            project_id=project_id,
+                            local_path=local_path,
+                            gemini_file_id=gemini_file_id
+                        ))
+
             db.session.commit()
+            with _UPLOAD_ID_CACHE_LOCK:
+                for local_path, gemini_file_id in entries.items():
+                    _UPLOAD_ID_CACHE[(project_id, local_path)] = gemini_file_id
         except Exception as e:
             db.session.rollback()
+            with _UPLOAD_ID_CACHE_LOCK:
+                for local_path in entries:
+                    _UPLOAD_ID_CACHE.pop((project_id, local_path), None)
             logging.error(f"Error saving upload cache to DB: {e}")
 
     def _generate_with_fallback(self, models: List[str], contents, config=None, tools=None) -> Optional[object]:
@@ -170,6 +325,7 @@ class GeminiService:
         if tools:
             final_config['tools'] = tools
 
+        _warn_if_db_connection_held("generate_content")
         errors = []
         for model in models:
             try:
@@ -210,6 +366,7 @@ class GeminiService:
         if tools:
             final_config['tools'] = tools
 
+        _warn_if_db_connection_held("generate_content_stream")
         errors = []
         for model in models:
             try:
@@ -247,7 +404,7 @@ class GeminiService:
             )
             if response and getattr(response, "text", None):
                 raw = (response.text or "").strip()
-                raw = re.sub(r"<br\s*/?>", "\n", raw)
+                raw = _BR_RE.sub("\n", raw)
                 return raw if raw else None
         except Exception as e:
             logging.warning("Chat title generation failed: %s", e)
@@ -260,40 +417,28 @@ class GeminiService:
         logging.info(f"[DEBUG] get_relevant_files called: question='{question}', process_name='{process_name}', max_files={max_files}")
         
         # 1. Fetch metadata for the project
-        project = Project.query.filter_by(name=process_name).first()
+        project = project_cache.get_project(process_name)
         if not project:
             logging.error(f"[DEBUG] Project {process_name} not found in database.")
             return []
         
         logging.info(f"[DEBUG] Found project: {project.name} (ID: {project.id})")
-        
-        metadata_items = ProjectMetadata.query.filter_by(project_id=project.id).all()
-        if not metadata_items:
-            logging.warning(f"[DEBUG] No metadata items found for project {process_name} (ID: {project.id})")
-            return []
 
-        logging.info(f"[DEBUG] Found {len(metadata_items)} metadata items for project {process_name}")
+        if USE_EMBEDDING_ROUTER:
+            try:
+                ranked = self._rank_files_by_embedding(question, project.id, max_files)
+                if ranked is not None:
+                    logging.info(f"[DEBUG] Returning {len(ranked)} relevant files (embedding router): {ranked}")
+                    return ranked
+            except Exception as e:
+                logging.warning(f"[DEBUG] Embedding router failed, falling back to Gemini routing: {e}")
 
-        # 2. Create metadata text representation
-        lines = []
-        for item in metadata_items:
-            lines.append(f"{item.id} | {item.type_of_data} | {item.file_name} | {item.file_path}")
-        metadata_text = "\n".join(lines)
-        
-        # Log sample metadata entries
-        sample_size = min(5, len(metadata_items))
-        logging.info(f"[DEBUG] Sample metadata entries (first {sample_size}):")
-        for i, line in enumerate(lines[:sample_size]):
-            logging.info(f"[DEBUG]   {i+1}. {line}")
-        if len(metadata_items) > sample_size:
-            logging.info(f"[DEBUG]   ... and {len(metadata_items) - sample_size} more entries")
-        
-        # Truncate if too long (same as old_code metadata_to_text: max_chars=30000)
-        max_chars = 30000
-        original_length = len(metadata_text)
-        if len(metadata_text) > max_chars:
-            metadata_text = metadata_text[: max_chars - 2000] + "\n...\n" + metadata_text[-1000:]
-            logging.warning(f"[DEBUG] Metadata text truncated from {original_length} to {len(metadata_text)} characters")
+        # 2. Metadata text representation (cached until the project's metadata changes)
+        metadata_text = self._get_metadata_text(project.id)
+        if not metadata_text:
+            logging.warning(f"[DEBUG] No metadata items found for project {process_name} (ID: {project.id})")
+            return []
+        _release_db_connection()
 
         # 3. Ask Gemini (same prompt as old_code process_qna/generic_process_qna.py)
         prompt = f"""
@@ -324,100 +469,19 @@ Metadata:
             response = self._generate_with_fallback(
                 models=self.routing_models,
                 contents=[{"role": "user", "parts": [{"text": prompt}]}],
-                config={"max_output_tokens": ROUTING_MAX_OUTPUT_TOKENS}
+                config={"max_output_tokens": ROUTING_MAX_OUTPUT_TOKENS, "response_mime_type": "application/json"}
             )
 
             text = (response.text or "").strip()
             logging.info(f"[DEBUG] Received response from Gemini (length: {len(text)} chars)")
             logging.info(f"[DEBUG] Raw response text: {text}")
             
-            # Clean Markdown
-            original_text = text
-            if text.startswith("```"):
-                text = text.strip("` \n")
-                text = text.replace("json", "", 1).strip()
-                logging.info(f"[DEBUG] Cleaned markdown from response. Original: '{original_text[:100]}...', Cleaned: '{text[:100]}...'")
-            
-            # Try multiple parsing methods
-            parsed_result = None
-            parse_method = None
-            
-            # Method 1: Try ast.literal_eval
-            try:
-                import ast
-                parsed_result = ast.literal_eval(text)
-                parse_method = "ast.literal_eval"
-                logging.info(f"[DEBUG] Successfully parsed with ast.literal_eval: {parsed_result}")
-            except Exception as e1:
-                logging.warning(f"[DEBUG] ast.literal_eval failed: {e1}")
-                
-                # Method 2: Try json.loads
-                try:
-                    parsed_result = json.loads(text)
-                    parse_method = "json.loads"
-                    logging.info(f"[DEBUG] Successfully parsed with json.loads: {parsed_result}")
-                except Exception as e2:
-                    logging.warning(f"[DEBUG] json.loads failed: {e2}")
-                    
-            # Method 3: Try to extract JSON array from text
-                    try:
-                        json_match = re.search(r'\[.*?\]', text, re.DOTALL)
-                        if json_match:
-                            json_str = json_match.group(0)
-                            parsed_result = json.loads(json_str)
-                            parse_method = "regex_extraction + json.loads"
-                            logging.info(f"[DEBUG] Successfully parsed with regex extraction: {parsed_result}")
-                    except Exception as e3:
-                        logging.warning(f"[DEBUG] Regex extraction failed: {e3}")
-            
-            # Method 4: Attempt to repair truncated JSON list
-            if parsed_result is None:
-                try:
-                    repaired_text = text.strip()
-                    # Check if it looks like a list that was cut off
-                    if repaired_text.startswith('['):
-                        # If it ends with a comma, remove it
-                        if repaired_text.endswith(','):
-                            repaired_text = repaired_text[:-1]
-                        
-                        # If it doesn't end with a bracket, try to close it
-                        if not repaired_text.endswith(']'):
-                            # Case 1: Ends with ", just add ]
-                            if repaired_text.endswith('"'):
-                                repaired_text += ']'
-                            # Case 2: Ends with unclosed string (e.g. "some text), need to close " then ]
-                            else:
-                                # Try appending "] first (assuming logic was inside a string)
-                                try:
-                                    temp_repair = repaired_text + '"]'
-                                    parsed_result = json.loads(temp_repair)
-                                    parse_method = "repair_truncated_json_string"
-                                    logging.info(f"[DEBUG] Successfully parsed with repair (appended '\"]'): {parsed_result}")
-                                except json.JSONDecodeError:
-                                    # Fallback: just append ] (assuming logic was inside a number or boolean or null)
-                                    try:
-                                        temp_repair = repaired_text + ']'
-                                        parsed_result = json.loads(temp_repair)
-                                        parse_method = "repair_truncated_json_bracket"
-                                        logging.info(f"[DEBUG] Successfully parsed with repair (appended ']'): {parsed_result}")
-                                    except json.JSONDecodeError:
-                                        # Last resort: if it ends with unexpected char, maybe trim until last comma and close
-                                        if ',' in repaired_text:
-                                            rpos = repaired_text.rfind(',')
-                                            temp_repair = repaired_text[:rpos] + ']'
-                                            parsed_result = json.loads(temp_repair)
-                                            parse_method = "repair_truncated_json_trim_last"
-                                            logging.info(f"[DEBUG] Successfully parsed with repair (trimmed to last comma): {parsed_result}")
-                except Exception as e4:
-                    logging.warning(f"[DEBUG] JSON repair failed: {e4}")
-
-            if parsed_result is not None and isinstance(parsed_result, list):
+            parsed_result = _parse_json_list(text)
+            if parsed_result is not None:
                 result = [str(x).strip() for x in parsed_result][:max_files]
-                logging.info(f"[DEBUG] Returning {len(result)} relevant files (parsed with {parse_method}): {result}")
+                logging.info(f"[DEBUG] Returning {len(result)} relevant files: {result}")
                 return result
-            else:
-                logging.error(f"[DEBUG] Failed to parse response as list. Parsed result: {parsed_result}, Type: {type(parsed_result)}")
-                logging.error(f"[DEBUG] Response text that failed to parse: '{text}'")
+            logging.error(f"[DEBUG] Response text that failed to parse as a list: '{text}'")
         
         except Exception as e:
             logging.error(f"[DEBUG] Exception in get_relevant_files: {e}", exc_info=True)
@@ -425,6 +489,83 @@ Metadata:
         logging.warning(f"[DEBUG] Returning empty list - no relevant files found")
         return []
 
+    def _metadata_version(self, project_id: int) -> Optional[int]:
+        """Project.metadata_version, bumped (project_cache.bump_metadata_version) on every metadata change."""
+        return db.session.execute(
+            select(Project.metadata_version).where(Project.id == project_id)
+        ).scalar_one_or_none()
+
+    def _embed_texts(self, texts: List[str], task_type: str) -> np.ndarray:
+        """Embed texts with the Gemini embedding model; rows are normalised to unit length."""
+        vectors = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            response = self.client.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=texts[start:start + EMBED_BATCH_SIZE],
+                config=types.EmbedContentConfig(task_type=task_type),
+            )
+            vectors.extend(e.values for e in response.embeddings)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def _rank_files_by_embedding(self, question: str, project_id: int, max_files: int) -> Optional[List[str]]:
+        """
+        Top max_files metadata file names by cosine similarity to the question, or None
+        when the project has no metadata. Row embeddings are computed once per metadata
+        version and kept in process; each question then costs one embedding call.
+        """
+        version = self._metadata_version(project_id)
+        with _METADATA_EMBEDDING_CACHE_LOCK:
+            cached = _METADATA_EMBEDDING_CACHE.get(project_id)
+        if cached is not None and cached[0] == version:
+            _release_db_connection()
+            _, file_names, matrix = cached
+        else:
+            rows = db.session.query(
+                ProjectMetadata.type_of_data, ProjectMetadata.file_name
+            ).filter(ProjectMetadata.project_id == project_id).order_by(ProjectMetadata.id).all()
+            if not rows:
+                return None
+            _release_db_connection()
+            file_names = [n for _, n in rows]
+            matrix = self._embed_texts([f"{t or ''} | {n}" for t, n in rows], "RETRIEVAL_DOCUMENT")
+            with _METADATA_EMBEDDING_CACHE_LOCK:
+                _METADATA_EMBEDDING_CACHE[project_id] = (version, file_names, matrix)
+
+        scores = matrix @ self._embed_texts([question], "RETRIEVAL_QUERY")[0]
+        k = min(max_files, len(file_names))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [file_names[i] for i in top]
+
+    def _get_metadata_text(self, project_id: int) -> str:
+        """
+        The "id | type_of_data | file_name | file_path" listing sent with routing prompts,
+        truncated like old_code metadata_to_text (max_chars=30000). One primary-key lookup
+        of the project's metadata_version checks whether the cached text is still current; rows are only read when it is not.
+        """
+        version = self._metadata_version(project_id)
+        with _METADATA_TEXT_CACHE_LOCK:
+            cached = _METADATA_TEXT_CACHE.get(project_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        rows = db.session.query(
+            ProjectMetadata.id, ProjectMetadata.type_of_data, ProjectMetadata.file_name, ProjectMetadata.file_path
+        ).filter(ProjectMetadata.project_id == project_id).order_by(ProjectMetadata.id).all()
+        metadata_text = "\n".join([f"{i} | {t} | {n} | {p}" for i, t, n, p in rows])
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(f"[DEBUG] Built metadata listing for project ID {project_id}: {len(rows)} items")
+        if len(metadata_text) > METADATA_TEXT_MAX_CHARS:
+            original_length = len(metadata_text)
+            metadata_text = metadata_text[: METADATA_TEXT_MAX_CHARS - 2000] + "\n...\n" + metadata_text[-1000:]
+            logging.warning(f"[DEBUG] Metadata text truncated from {original_length} to {len(metadata_text)} characters")
+
+        with _METADATA_TEXT_CACHE_LOCK:
+            _METADATA_TEXT_CACHE[project_id] = (version, metadata_text)
+        return metadata_text
+
     def upload_file_if_needed(self, local_path: str, process_name: str, cache_key: Optional[str] = None) -> Optional[str]:
         """
         Upload a file to Gemini if not already cached for this project.
@@ -436,24 +577,87 @@ Metadata:
           so that multiple temp downloads of the same object reuse the same Gemini file.
         """
         logging.info(f"[DEBUG] upload_file_if_needed called: local_path='{local_path}', process_name='{process_name}', cache_key='{cache_key}'")
+        return self.upload_files_if_needed([(local_path, cache_key)], process_name)[0]
 
-        key = cache_key or local_path
-        
-        # Check cache first (load specific entry for this path/identifier)
-        cache = self._load_upload_cache(process_name, local_path=key)
-        logging.debug(f"[DEBUG] Cache lookup result for key '{key}': {cache}")
-        
-        if key in cache:
-            file_id = cache[key]
-            logging.info(f"[DEBUG] Found cached file ID: {file_id}")
+    def _upload_source(self, file_path: str, project_name: str, use_s3: bool) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """
+        (local_path, cache_key) for upload_files_if_needed, or None if the document cannot be found.
+        In S3 mode nothing is downloaded here: the object key is the cache key, and the upload
+        thread fetches the object only if Gemini does not already hold an ACTIVE copy.
+        """
+        if use_s3:
+            return None, file_path
+        resolved_path, found = self._resolve_file_path(file_path, project_name)
+        return (resolved_path, None) if found and resolved_path else None
+
+    def upload_files_if_needed(self, items: List[Tuple[Optional[str], Optional[str]]], process_name: str) -> List[Optional[str]]:
+        """
+        Upload several files for a project concurrently, skipping those already cached.
+
+        - items: (local_path, cache_key) pairs, as for upload_file_if_needed. local_path may be
+          None when cache_key is a storage identifier that still has to be fetched (see _upload_source).
+        Returns the Gemini file ids in the same order (None where an upload failed).
+        The cache is read with one query up front and new ids are saved afterwards, so the
+        upload threads never touch the database. Each thread runs fetch -> upload -> ACTIVE wait
+        for its own file, so one file's download overlaps another's upload or polling and the
+        total time is roughly the slowest file.
+        """
+        if not items:
+            return []
+
+        keys = [cache_key or local_path for local_path, cache_key in items]
+        cache = self._load_upload_cache_bulk(process_name, keys)
+        # Uploads and ACTIVE polling can take seconds; don't hold a connection through them
+        _release_db_connection()
+        logging.debug(f"[DEBUG] Cache lookup result for keys {keys}: {cache}")
+        jobs = [(local_path, cache.get(key), key) for (local_path, _), key in zip(items, keys)]
+        app = current_app._get_current_object()
+
+        if len(jobs) == 1:
+            results = [self._upload_and_activate(*jobs[0], process_name=process_name, app=app)]
+        else:
+            futures = [
+                _FILE_UPLOAD_POOL.submit(self._upload_and_activate, local_path, cached_id, key,
+                                         process_name=process_name, app=app)
+                for local_path, cached_id, key in jobs
+            ]
+            results = [future.result() for future in futures]
+
+        new_entries = {
+            key: file_id
+            for (_, cached_id, key), file_id in zip(jobs, results)
+            if file_id and file_id != cached_id
+        }
+        if new_entries:
+            self._save_upload_cache_many(process_name, new_entries)
+        return results
+
+    def _upload_and_activate(self, local_path: Optional[str], cached_id: Optional[str] = None,
+                             storage_id: Optional[str] = None, process_name: Optional[str] = None,
+                             app=None) -> Optional[str]:
+        """
+        Return a usable (ACTIVE) Gemini file id for local_path: cached_id if it is still
+        active, otherwise a fresh upload. When local_path is None the document is first
+        resolved from storage_id (an S3 download) inside an app context pushed on `app`.
+        Makes no database calls, so it can run on any thread.
+        """
+        if cached_id:
+            logging.info(f"[DEBUG] Found cached file ID: {cached_id}")
             try:
-                file_obj = self.client.files.get(name=file_id)
+                file_obj = self.client.files.get(name=cached_id)
                 logging.debug(f"[DEBUG] Cached file state: {file_obj.state}")
                 if file_obj.state == "ACTIVE":
-                    logging.info(f"[DEBUG] Using cached file (ACTIVE): {file_id}")
-                    return file_id
+                    logging.info(f"[DEBUG] Using cached file (ACTIVE): {cached_id}")
+                    return cached_id
             except Exception as e:
-                logging.warning(f"[DEBUG] Cached file {file_id} invalid. Error: {e}. Re-uploading.")
+                logging.warning(f"[DEBUG] Cached file {cached_id} invalid. Error: {e}. Re-uploading.")
+
+        if local_path is None:
+            with app.app_context():
+                local_path, found = self._resolve_file_path(storage_id, process_name)
+            if not found or not local_path:
+                logging.warning(f"[DEBUG] File not found (skipping): {storage_id} for project {process_name}")
+                return None
 
         if not os.path.exists(local_path):
             logging.error(f"[DEBUG] File not found: {local_path}")
@@ -488,10 +692,7 @@ Metadata:
         try:
             logging.info(f"[DEBUG] Uploading file to Gemini: {upload_path}")
          
-            try:
-                uploaded_file = self.client.files.upload(file=upload_path)
-            except TypeError:
-                uploaded_file = self.client.files.upload(path=upload_path)
+            uploaded_file = self.client.files.upload(**{self._upload_kwarg: upload_path})
             logging.info(f"[DEBUG] File uploaded, Gemini file name: {uploaded_file.name}")
             
             # Clean up temp file
@@ -503,21 +704,8 @@ Metadata:
                     logging.warning(f"[DEBUG] Failed to remove temp file {temp_file}: {e}")
             
             # Wait for processing
-            logging.info(f"[DEBUG] Waiting for file to become ACTIVE (max ~15 seconds)...")
-            for attempt in range(15):
-                file_check = self.client.files.get(name=uploaded_file.name)
-                logging.debug(f"[DEBUG] File check attempt {attempt + 1}/30: state={file_check.state}")
-                if file_check.state == "ACTIVE":
-                    logging.info(f"[DEBUG] File is ACTIVE, saving to cache and returning: {uploaded_file.name}")
-                    self._save_upload_cache(process_name, key, uploaded_file.name)
-                    return uploaded_file.name
-                elif file_check.state == "FAILED":
-                    logging.error(f"[DEBUG] File upload failed (state=FAILED): {local_path}")
-                    return None
-                time.sleep(1)
-            
-            logging.error(f"[DEBUG] File upload timed out after 15 seconds: {local_path}")
-            return None
+            logging.info(f"[DEBUG] Waiting for file to become ACTIVE (max ~{FILE_ACTIVE_TIMEOUT_SECONDS:g} seconds)...")
+            return self._wait_for_active(uploaded_file.name, local_path)
         except Exception as e:
             logging.error(f"[DEBUG] Exception uploading file {local_path}: {e}", exc_info=True)
             return None
@@ -531,24 +719,39 @@ Metadata:
             logging.error(f"[DEBUG] User comparison file not found: {local_path}")
             return None
         try:
-            try:
-                uploaded_file = self.client.files.upload(file=local_path)
-            except TypeError:
-                uploaded_file = self.client.files.upload(path=local_path)
-            for _ in range(15):
-                fobj = self.client.files.get(name=uploaded_file.name)
-                if fobj.state == "ACTIVE":
-                    return uploaded_file.name
-                if fobj.state == "FAILED":
-                    logging.error(f"[DEBUG] User comparison file upload FAILED: {local_path}")
-                    return None
-                time.sleep(1)
-            logging.error(f"[DEBUG] User comparison file upload timed out: {local_path}")
-            return None
+            uploaded_file = self.client.files.upload(**{self._upload_kwarg: local_path})
+            return self._wait_for_active(uploaded_file.name, local_path)
         except Exception as e:
             logging.error(f"[DEBUG] User comparison upload error: {e}", exc_info=True)
             return None
 
+    def _wait_for_active(self, name: str, local_path: str, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Poll an uploaded file until Gemini marks it ACTIVE and return its name, or None
+        if processing FAILED or the timeout ran out. Checks start 100 ms apart and back
+        off to one second, so small files are picked up as soon as they are ready.
+        """
+        if timeout is None:
+            timeout = FILE_ACTIVE_TIMEOUT_SECONDS
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            state = self.client.files.get(name=name).state
+            logging.debug(f"[DEBUG] File {name} state={state}")
+            if state == "ACTIVE":
+                logging.info(f"[DEBUG] File is ACTIVE, returning: {name}")
+                return name
+            if state == "FAILED":
+                logging.error(f"[DEBUG] File upload failed (state=FAILED): {local_path}")
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+        logging.error(f"[DEBUG] File upload timed out after {timeout:g} seconds: {local_path}")
+        return None
+
     def identify_visual_pages(self, question: str, file_id: str) -> List[int]:
         """
         Identify pages/indices containing visuals relevant to the question.
@@ -602,45 +805,14 @@ Metadata:
             response = self._generate_with_fallback(
                 models=self.routing_models,
                 contents=[prompt, types.Part.from_uri(file_uri=file_obj.uri, mime_type=file_obj.mime_type)],
-                config={"max_output_tokens": 300}
+                config={"max_output_tokens": VISUAL_PAGES_MAX_OUTPUT_TOKENS, "response_mime_type": "application/json"}
             )
-            import ast
-            text = (response.text or "").strip()
-            original_text = text
-            # Clean Markdown if any
-            if text.startswith("```"):
-                text = text.strip("` \n")
-                text = text.replace("json", "", 1).strip()
-
-            parsed = None
-
-            # First try ast.literal_eval on the raw (cleaned) text
-            try:
-                parsed = ast.literal_eval(text)
-            except Exception:
-                # Fallback: try json.loads
-                try:
-                    parsed = json.loads(text)
-                except Exception:
-                    # Fallback: extract the first [...] block and parse it
-                    try:
-                        match = re.search(r'\[.*?\]', text, re.DOTALL)
-                        if match:
-                            block = match.group(0)
-                            try:
-                                parsed = json.loads(block)
-                            except Exception:
-                                parsed = ast.literal_eval(block)
-                    except Exception:
-                        parsed = None
+            original_text = (response.text or "").strip()
+            parsed = _parse_json_list(original_text)
 
             # Last-resort fallback: pull out integers from whatever the model returned
             if parsed is None:
-                try:
-                    nums = re.findall(r'\d+', text)
-                    parsed = [int(n) for n in nums]
-                except Exception:
-                    parsed = None
+                parsed = [int(n) for n in _INT_RE.findall(original_text)]
 
             if isinstance(parsed, list):
                 return [max(0, int(p) - 1) for p in parsed if isinstance(p, int) or (isinstance(p, str) and p.isdigit())]
@@ -664,8 +836,8 @@ Metadata:
 
             # region agent log
             try:
-                with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-                    _f.write(json.dumps({
+                with open("debug-0484fb.log", "ab") as _f:
+                    _f.write(orjson.dumps({
                         "sessionId": "0484fb",
                         "runId": "pre-fix-1",
                         "hypothesisId": "H1",
@@ -676,7 +848,7 @@ Metadata:
                             "local_path": local_path,
                         },
                         "timestamp": int(time.time() * 1000),
-                    }) + "\n")
+                    }) + b"\n")
             except Exception:
                 pass
             # endregion
@@ -685,8 +857,8 @@ Metadata:
 
             # region agent log
             try:
-                with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-                    _f.write(json.dumps({
+                with open("debug-0484fb.log", "ab") as _f:
+                    _f.write(orjson.dumps({
                         "sessionId": "0484fb",
                         "runId": "pre-fix-1",
                         "hypothesisId": "H1",
@@ -696,7 +868,7 @@ Metadata:
                             "got_file_id": bool(file_id),
                         },
                         "timestamp": int(time.time() * 1000),
-                    }) + "\n")
+                    }) + b"\n")
             except Exception:
                 pass
             # endregion
@@ -723,8 +895,8 @@ STRICT RULES:
 
             # region agent log
             try:
-                with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-                    _f.write(json.dumps({
+                with open("debug-0484fb.log", "ab") as _f:
+                    _f.write(orjson.dumps({
                         "sessionId": "0484fb",
                         "runId": "pre-fix-1",
                         "hypothesisId": "H2",
@@ -735,7 +907,7 @@ STRICT RULES:
                             "file_mime_type": getattr(file_obj, "mime_type", None),
                         },
                         "timestamp": int(time.time() * 1000),
-                    }) + "\n")
+                    }) + b"\n")
             except Exception:
                 pass
             # endregion
@@ -836,8 +1008,8 @@ STRICT RULES:
 
             # region agent log
             try:
-                with open("debug-0484fb.log", "a", encoding="utf-8") as _f:
-                    _f.write(json.dumps({
+                with open("debug-0484fb.log", "ab") as _f:
+                    _f.write(orjson.dumps({
                         "sessionId": "0484fb",
                         "runId": "pre-fix-1",
                         "hypothesisId": "H3",
@@ -848,7 +1020,7 @@ STRICT RULES:
                             "raw_text_preview": str(raw_text)[:120] if raw_text else None,
                         },
                         "timestamp": int(time.time() * 1000),
-                    }) + "\n")
+                    }) + b"\n")
             except Exception:
                 pass
             # endregion
@@ -887,8 +1059,8 @@ STRICT RULES:
                 return None
 
             text = str(raw_text).strip()
-            text = re.sub(r"<br\s*/?>", " ", text)
-            text = re.sub(r"\s+", " ", text).strip()
+            text = _BR_RE.sub(" ", text)
+            text = _WHITESPACE_RE.sub(" ", text).strip()
 
             # Enforce word limit
             words = text.split()
@@ -933,18 +1105,19 @@ STRICT RULES:
             except Exception:
                 use_s3_for_docs = False
 
+            to_upload = []
             for fname in project_filenames:
                 meta = ProjectMetadata.query.filter(
                     ProjectMetadata.project_id == project.id,
                     ProjectMetadata.file_name.ilike(f"%{fname}%"),
                 ).first()
                 if meta:
-                    resolved_path, found = self._resolve_file_path(meta.file_path, process_name)
-                    if found and resolved_path:
-                        cache_key = meta.file_path if use_s3_for_docs else None
-                        fid = self.upload_file_if_needed(resolved_path, process_name, cache_key=cache_key)
-                        if fid and fid not in project_gemini_ids:
-                            project_gemini_ids.append(fid)
+                    source = self._upload_source(meta.file_path, process_name, use_s3_for_docs)
+                    if source:
+                        to_upload.append(source)
+            for fid in self.upload_files_if_needed(to_upload, process_name):
+                if fid and fid not in project_gemini_ids:
+                    project_gemini_ids.append(fid)
         # Order as in old_code: internal (project) docs first, then user-uploaded doc
         all_ids = list(dict.fromkeys(project_gemini_ids + user_file_ids))
         if len(all_ids) < 2:
@@ -1199,13 +1372,14 @@ Answer style: {style_instruction}
                 process_name,
                 valid_files,
             )
+            _release_db_connection()
             response = self._generate_with_fallback(
                 models=self.answer_models,
                 contents=api_parts,
                 config={"max_output_tokens": ANSWER_MAX_OUTPUT_TOKENS}
             )
             answer_text = (response.text or "").strip()
-            answer_text = re.sub(r"<br\s*/?>", "\n", answer_text)
+            answer_text = _BR_RE.sub("\n", answer_text)
             try:
                 if response.candidates and response.candidates[0].finish_reason != "STOP":
                     logging.warning("Comparison response may be incomplete (finish_reason=%s).", getattr(response.candidates[0], "finish_reason", "?"))
@@ -1269,6 +1443,7 @@ Answer style: {style_instruction}
                     except Exception:
                         use_s3_for_docs = False
 
+                    to_upload = []
                     for fname in relevant_filenames:
                         logging.info(f"[DEBUG] Searching for file matching: '{fname}' in project {process_name}")
                         meta = ProjectMetadata.query.filter(
@@ -1277,23 +1452,26 @@ Answer style: {style_instruction}
                         ).first()
                         if meta:
                             logging.info(f"[DEBUG] Found metadata entry: ID={meta.id}, file_name='{meta.file_name}', file_path='{meta.file_path}'")
-                            resolved_path, found = self._resolve_file_path(meta.file_path, process_name)
-                            if found and resolved_path:
-                                logging.info(f"[DEBUG] File resolved successfully: {resolved_path}")
-                                cache_key = meta.file_path if use_s3_for_docs else None
-                                fid = self.upload_file_if_needed(resolved_path, process_name, cache_key=cache_key)
-                                if fid:
-                                    logging.info(f"[DEBUG] File uploaded to Gemini with ID: {fid}")
-                                    attachment_ids.append(fid)
-                                    full_file_paths.append(resolved_path)
-                                    # Store the stable storage identifier from metadata (not the temp/local path)
-                                    storage_paths.append(meta.file_path)
-                                else:
-                                    logging.error(f"[DEBUG] Failed to upload file to Gemini: {resolved_path}")
+                            source = self._upload_source(meta.file_path, process_name, use_s3_for_docs)
+                            if source:
+                                logging.info(f"[DEBUG] File resolved successfully: {source[0] or source[1]}")
+                                to_upload.append((*source, meta.file_path))
                             else:
                                 logging.warning(f"[DEBUG] File not found (skipping): {meta.file_path} for project {process_name}")
                         else:
                             logging.warning(f"[DEBUG] No metadata entry found matching filename: '{fname}' in project {process_name}")
+
+                    # Upload all resolved files side by side, then keep the original order
+                    fids = self.upload_files_if_needed([(path, key) for path, key, _ in to_upload], process_name)
+                    for (resolved_path, _, storage_path), fid in zip(to_upload, fids):
+                        if fid:
+                            logging.info(f"[DEBUG] File uploaded to Gemini with ID: {fid}")
+                            attachment_ids.append(fid)
+                            full_file_paths.append(resolved_path or storage_path)
+                            # Store the stable storage identifier from metadata (not the temp/local path)
+                            storage_paths.append(storage_path)
+                        else:
+                            logging.error(f"[DEBUG] Failed to upload file to Gemini: {resolved_path or storage_path}")
                 else:
                     logging.error(f"[DEBUG] Project {process_name} not found when processing relevant files")
             else:
@@ -1322,6 +1500,7 @@ Answer style: {style_instruction}
 
                 logging.info(f"[DEBUG] Processing {len(files_for_project)} files for project {pname}: {files_for_project}")
                 
+                to_upload = []
                 for fname in files_for_project:
                     logging.info(f"[DEBUG] Searching for file matching: '{fname}' in project {pname}")
                     meta = ProjectMetadata.query.filter(
@@ -1333,29 +1512,32 @@ Answer style: {style_instruction}
                         continue
 
                     logging.info(f"[DEBUG] Found metadata entry: ID={meta.id}, file_name='{meta.file_name}', file_path='{meta.file_path}'")
-                    resolved_path, found = self._resolve_file_path(meta.file_path, pname)
-                    if not found or not resolved_path:
+                    source = self._upload_source(meta.file_path, pname, use_s3_for_docs)
+                    if not source:
                         logging.warning(f"[DEBUG] File not found (skipping): {meta.file_path} for project {pname}")
                         continue
 
-                    if resolved_path in seen_paths:
-                        logging.debug(f"[DEBUG] File already processed (duplicate): {resolved_path}")
+                    seen_key = source[0] or source[1]
+                    if seen_key in seen_paths:
+                        logging.debug(f"[DEBUG] File already processed (duplicate): {seen_key}")
                         continue
-                    seen_paths.add(resolved_path)
+                    seen_paths.add(seen_key)
+
+                    logging.info(f"[DEBUG] Uploading file: {seen_key}")
+                    to_upload.append((*source, meta.file_path, fname))
 
-                    logging.info(f"[DEBUG] Uploading file: {resolved_path}")
-                    cache_key = meta.file_path if use_s3_for_docs else None
-                    fid = self.upload_file_if_needed(resolved_path, pname, cache_key=cache_key)
+                fids = self.upload_files_if_needed([(path, key) for path, key, _, _ in to_upload], pname)
+                for (resolved_path, _, storage_path, fname), fid in zip(to_upload, fids):
                     if fid:
                         logging.info(f"[DEBUG] File uploaded to Gemini with ID: {fid}")
                         attachment_ids.append(fid)
-                        full_file_paths.append(resolved_path)
+                        full_file_paths.append(resolved_path or storage_path)
                         # Use the underlying storage identifier (meta.file_path) for any external references
-                        storage_paths.append(meta.file_path)
+                        storage_paths.append(storage_path)
                         relevant_filenames.append(fname)
                         process_file_map.setdefault(pname, []).append(fid)
                     else:
-                        logging.error(f"[DEBUG] Failed to upload file to Gemini: {resolved_path}")
+                        logging.error(f"[DEBUG] Failed to upload file to Gemini: {resolved_path or storage_path}")
 
         # 2. Answer only from documents: if no documents found, do not call the LLM (same as old_code)
         logging.info(f"[DEBUG] Total attachment IDs collected: {len(attachment_ids)}")
@@ -1517,6 +1699,7 @@ Answer style: {style_instruction}
         # but pure dict `[{"google_search": {}}]` is often supported or `types.Tool(google_search=...)`
         # We will pass it to `generate_content` via our helper.
         
+        _release_db_connection()
         response = self._generate_with_fallback(
             models=self.answer_models,
             contents=api_contents,
@@ -1525,7 +1708,7 @@ Answer style: {style_instruction}
         )
 
         answer_text = (response.text or "").strip()
-        answer_text = re.sub(r"<br\s*/?>", "\n", answer_text)
+        answer_text = _BR_RE.sub("\n", answer_text)
         try:
             if response.candidates and response.candidates[0].finish_reason != "STOP":
                 logging.warning("Answer response may be incomplete (finish_reason=%s).", getattr(response.candidates[0], "finish_reason", "?"))
@@ -1592,20 +1775,23 @@ Answer style: {style_instruction}
                     except Exception:
                         use_s3_for_docs = False
 
+                    to_upload = []
                     for fname in relevant_filenames:
                         meta = ProjectMetadata.query.filter(
                             ProjectMetadata.project_id == project.id,
                             ProjectMetadata.file_name.ilike(f"%{fname}%")
                         ).first()
                         if meta:
-                            resolved_path, found = self._resolve_file_path(meta.file_path, process_name)
-                            if found and resolved_path:
-                                cache_key = meta.file_path if use_s3_for_docs else None
-                                fid = self.upload_file_if_needed(resolved_path, process_name, cache_key=cache_key)
-                                if fid:
-                                    attachment_ids.append(fid)
-                                    full_file_paths.append(resolved_path)
-                                    storage_paths.append(meta.file_path)
+                            source = self._upload_source(meta.file_path, process_name, use_s3_for_docs)
+                            if source:
+                                to_upload.append((*source, meta.file_path))
+
+                    fids = self.upload_files_if_needed([(path, key) for path, key, _ in to_upload], process_name)
+                    for (resolved_path, _, storage_path), fid in zip(to_upload, fids):
+                        if fid:
+                            attachment_ids.append(fid)
+                            full_file_paths.append(resolved_path or storage_path)
+                            storage_paths.append(storage_path)
         else:
             process_file_map = {}
             all_projects = [process_name] + list({p for p in (related_processes or []) if p != process_name})
@@ -1625,6 +1811,7 @@ Answer style: {style_instruction}
                 except Exception:
                     use_s3_for_docs = False
 
+                to_upload = []
                 for fname in files_for_project:
                     meta = ProjectMetadata.query.filter(
                         ProjectMetadata.project_id == project.id,
@@ -1632,18 +1819,21 @@ Answer style: {style_instruction}
                     ).first()
                     if not meta:
                         continue
-                    resolved_path, found = self._resolve_file_path(meta.file_path, pname)
-                    if not found or not resolved_path:
+                    source = self._upload_source(meta.file_path, pname, use_s3_for_docs)
+                    if not source:
                         continue
-                    if resolved_path in seen_paths:
+                    seen_key = source[0] or source[1]
+                    if seen_key in seen_paths:
                         continue
-                    seen_paths.add(resolved_path)
-                    cache_key = meta.file_path if use_s3_for_docs else None
-                    fid = self.upload_file_if_needed(resolved_path, pname, cache_key=cache_key)
+                    seen_paths.add(seen_key)
+                    to_upload.append((*source, meta.file_path, fname))
+
+                fids = self.upload_files_if_needed([(path, key) for path, key, _, _ in to_upload], pname)
+                for (resolved_path, _, storage_path, fname), fid in zip(to_upload, fids):
                     if fid:
                         attachment_ids.append(fid)
-                        full_file_paths.append(resolved_path)
-                        storage_paths.append(meta.file_path)
+                        full_file_paths.append(resolved_path or storage_path)
+                        storage_paths.append(storage_path)
                         relevant_filenames.append(fname)
                         process_file_map.setdefault(pname, []).append(fid)
 
@@ -1780,8 +1970,8 @@ Answer style: {style_instruction}
 
         # region agent log
         try:
-            with open("debug-db50b1.log", "a", encoding="utf-8") as _f:
-                _f.write(json.dumps({
+            with open("debug-db50b1.log", "ab") as _f:
+                _f.write(orjson.dumps({
                     "sessionId": "db50b1",
                     "runId": "pre-fix-1-stream",
                     "hypothesisId": "H3",
@@ -1796,12 +1986,13 @@ Answer style: {style_instruction}
                         "tools_enabled": bool(tools),
                     },
                     "timestamp": int(time.time() * 1000),
-                }) + "\n")
+                }) + b"\n")
         except Exception:
             pass
         # endregion
 
         answer_text = ""
+        _release_db_connection()
         try:
             for chunk_text in self._generate_stream_with_fallback(
                 models=self.answer_models,
@@ -1817,7 +2008,7 @@ Answer style: {style_instruction}
             return
 
         answer_text = (answer_text or "").strip()
-        answer_text = re.sub(r"<br\s*/?>", "\n", answer_text)
+        answer_text = _BR_RE.sub("\n", answer_text)
 
         visual_pages = []
         if extract_visuals and attachment_ids and full_file_paths:
@@ -1836,3 +2027,17 @@ Answer style: {style_instruction}
 
         logging.info(f"[DEBUG] Final visual_pages (Stream): {visual_pages}")
         yield {"type": "done", "answer": answer_text, "relevant_files": relevant_filenames, "visuals": visual_pages}
+
+
+def get_gemini_service() -> GeminiService:
+    """
+    Return the app's shared GeminiService, creating it on first use in each worker.
+    The service holds no per-request state and the genai client is safe to share
+    between threads, so one instance (and its HTTP connection pool) serves all requests.
+    """
+    app = current_app._get_current_object()
+    service = app.extensions.get('gemini')
+    if service is None:
+        service = GeminiService(api_key=app.config.get('GEMINI_API_KEY'))
+        app.extensions['gemini'] = service
+    return service
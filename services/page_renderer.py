@@ -0,0 +1,164 @@
+"""
+Rasterise PDF pages for /api/visual with two process-local caches:
+
+- rendered page images, keyed by document, version, page and render options, so
+  scrolling back through the viewer is a dictionary lookup;
+- open fitz.Document handles, so rendering another page of the same file does not
+  parse the PDF again.
+
+The document version (local mtime/size or the S3 ETag) is part of every key, so a
+replaced file is never served from a stale entry.
+"""
+import os
+import threading
+from typing import Optional, Tuple
+
+import cachetools
+import fitz  # PyMuPDF
+
+PAGE_CACHE_SIZE = 512
+DOC_HANDLE_CACHE_SIZE = 32
+LOSSY_QUALITY = 85
+
+
+class _DocumentHandle:
+    """
+    An open fitz.Document plus the lock that serialises access to it (MuPDF is not
+    thread-safe). `temp_path` is the S3 download the document was opened from, if any;
+    it is removed when the handle is closed.
+    """
+
+    def __init__(self, doc, temp_path: Optional[str] = None):
+        self.doc = doc
+        self.temp_path = temp_path
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.doc.close()
+                _remove_temp(self.temp_path)
+
+
+class _DocumentHandleCache(cachetools.LRUCache):
+    """LRU of document handles that closes a document when it is evicted."""
+
+    def popitem(self):
+        key, handle = super().popitem()
+        handle.close()
+        return key, handle
+
+
+_PAGE_CACHE = cachetools.LRUCache(maxsize=PAGE_CACHE_SIZE)
+_PAGE_CACHE_LOCK = threading.Lock()
+_DOC_HANDLES = _DocumentHandleCache(maxsize=DOC_HANDLE_CACHE_SIZE)
+_DOC_HANDLES_LOCK = threading.Lock()
+
+
+def _remove_temp(path: Optional[str]) -> None:
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _open_document(storage, storage_id: str, project_name: Optional[str]) -> Optional[_DocumentHandle]:
+    """
+    Open a stored PDF from a file rather than from bytes in memory, so MuPDF reads pages
+    on demand and a cached handle does not pin a full copy of the document. On S3 the
+    object is streamed to a temporary file that belongs to the returned handle.
+    """
+    local_path = storage.ensure_local_path(storage_id, project_name=project_name)
+    if not local_path:
+        return None
+    temp_path = local_path if storage.use_s3 else None
+    try:
+        doc = fitz.open(local_path)
+    except Exception:
+        _remove_temp(temp_path)
+        raise
+    return _DocumentHandle(doc, temp_path)
+
+
+def _get_handle(storage, storage_id: str, version: str, project_name: Optional[str]) -> Optional[_DocumentHandle]:
+    key = (storage_id, version)
+    with _DOC_HANDLES_LOCK:
+        handle = _DOC_HANDLES.get(key)
+    if handle is not None:
+        return handle
+
+    handle = _open_document(storage, storage_id, project_name)
+    if handle is None:
+        return None
+    with _DOC_HANDLES_LOCK:
+        existing = _DOC_HANDLES.get(key)
+        if existing is not None:
+            # Another thread opened it first; keep theirs
+            handle.close()
+            return existing
+        _DOC_HANDLES[key] = handle
+    return handle
+
+
+def render_page(storage, storage_id: str, page_num: int, project_name: Optional[str] = None,
+                scale: float = 1.0, clip: Optional[Tuple[float, float, float, float]] = None,
+                fmt: str = "png", version: Optional[str] = None) -> Optional[bytes]:
+    """
+    Return page `page_num` of a stored PDF as image bytes, or None if the document
+    cannot be found. Raises IndexError if the page does not exist.
+
+    `scale` multiplies the 72 DPI base resolution, `clip` is an optional (x, y, w, h)
+    tile in page points (only that region is rasterised) and `fmt` is "png", "jpeg" or "webp".
+    Pass `version` if the caller already has the document's storage.version_tag().
+    """
+    if version is None:
+        version = storage.version_tag(storage_id, project_name=project_name)
+    if version is None:
+        return None
+
+    page_key = (storage_id, version, page_num, scale, clip, fmt)
+    with _PAGE_CACHE_LOCK:
+        image = _PAGE_CACHE.get(page_key)
+    if image is not None:
+        return image
+
+    handle = _get_handle(storage, storage_id, version, project_name)
+    if handle is None:
+        return None
+    with handle.lock:
+        if handle.closed:
+            # Evicted between lookup and use; render from a private copy this once
+            private = _open_document(storage, storage_id, project_name)
+            if private is None:
+                return None
+            try:
+                image = _render(private.doc, page_num, scale, clip, fmt)
+            finally:
+                private.close()
+        else:
+            image = _render(handle.doc, page_num, scale, clip, fmt)
+
+    with _PAGE_CACHE_LOCK:
+        _PAGE_CACHE[page_key] = image
+    return image
+
+
+def _render(doc, page_num: int, scale: float, clip, fmt: str) -> bytes:
+    if page_num < 0 or page_num >= len(doc):
+        raise IndexError(page_num)
+    page = doc[page_num]
+    rect = None
+    if clip:
+        x, y, w, h = clip
+        # Keep the tile inside the page so MuPDF never renders empty space
+        rect = fitz.Rect(x, y, x + w, y + h) & page.rect
+    # No alpha channel: pages are opaque, and it saves a quarter of the pixel data
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=rect, alpha=False)
+    if fmt == "webp":
+        return pix.pil_tobytes("WEBP", quality=LOSSY_QUALITY)
+    if fmt == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=LOSSY_QUALITY)
+    return pix.tobytes("png")
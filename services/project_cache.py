@@ -0,0 +1,64 @@
+"""
+Short-lived, process-local cache of project lookups by name.
+
+Nearly every chat, session and file endpoint starts by resolving the project in
+the URL; project rows change rarely, so hits are kept for a minute. The admin
+routes invalidate entries when a project is renamed or deleted (other workers
+pick the change up when their entry expires).
+"""
+import threading
+from collections import namedtuple
+from typing import Optional
+
+from cachetools import TTLCache
+from sqlalchemy import select, update
+
+from extensions import db
+from models.project import Project
+
+# Detached, immutable snapshot of the columns routes need from a Project row
+ProjectRef = namedtuple('ProjectRef', ['id', 'name', 'description'])
+
+PROJECT_CACHE_TTL_SECONDS = 60
+
+_PROJECTS = TTLCache(maxsize=1024, ttl=PROJECT_CACHE_TTL_SECONDS)
+_PROJECTS_LOCK = threading.Lock()
+
+
+def get_project(name: str) -> Optional[ProjectRef]:
+    """Return the project with this name, or None if there is none."""
+    with _PROJECTS_LOCK:
+        project = _PROJECTS.get(name)
+    if project is not None:
+        return project
+
+    row = db.session.execute(
+        select(Project.id, Project.name, Project.description).where(Project.name == name)
+    ).first()
+    if row is None:
+        return None
+    project = ProjectRef(*row)
+    with _PROJECTS_LOCK:
+        _PROJECTS[name] = project
+    return project
+
+
+def bump_metadata_version(project_id: int) -> None:
+    """
+    Mark a project's metadata as changed, in the caller's transaction. Call this
+    alongside every insert, edit or delete of its ProjectMetadata rows.
+    """
+    db.session.execute(
+        update(Project)
+        .where(Project.id == project_id)
+        .values(metadata_version=Project.metadata_version + 1)
+    )
+
+
+def invalidate(name: Optional[str] = None) -> None:
+    """Forget one cached project (or all of them when name is None)."""
+    with _PROJECTS_LOCK:
+        if name is None:
+            _PROJECTS.clear()
+        else:
+            _PROJECTS.pop(name, None)
@@ -1,7 +1,9 @@
 import logging
 from typing import List, Tuple, Dict, Optional
 
-from services.gemini_service import GeminiService
+from flask import current_app
+
+from services.gemini_service import GeminiService, get_gemini_service
 
 
 class QnAService:
@@ -14,10 +16,10 @@ class QnAService:
     and other backend code – it does NOT touch any web framework global state.
     """
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, gemini_service: Optional[GeminiService] = None):
         if not api_key:
             raise ValueError("GEMINI_API_KEY is required to initialize QnAService.")
-        self._gemini = GeminiService(api_key=api_key)
+        self._gemini = gemini_service or GeminiService(api_key=api_key)
 
     # -------------------------------------------------------------------------
     # Single‑project Q&A (core path used by /api/chat/<project_name>)
@@ -204,3 +206,15 @@ class QnAService:
         """
         return self._gemini.generate_chat_title(question=question, max_words=max_words)
 
+
+def get_qna_service() -> QnAService:
+    """
+    Return the app's shared QnAService, built on the shared GeminiService so every
+    request reuses one genai client and its keep-alive connections.
+    """
+    app = current_app._get_current_object()
+    service = app.extensions.get('qna')
+    if service is None:
+        service = QnAService(api_key=app.config.get('GEMINI_API_KEY'), gemini_service=get_gemini_service())
+        app.extensions['qna'] = service
+    return service
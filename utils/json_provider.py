@@ -0,0 +1,53 @@
+import decimal
+from typing import Any
+
+import orjson
+from flask.json.provider import JSONProvider
+
+
+def _option(sort_keys: bool = False, indent: bool = False) -> int:
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return option
+
+
+def _default(obj: Any) -> Any:
+    """Serialize the extra types Flask's default provider supports and orjson does not."""
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify(), request.get_json() and the
+    |tojson template filter.
+
+    Differences from Flask's default provider: keys are not sorted and datetimes
+    are written as ISO 8601 (the routes already pass .isoformat() strings).
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = _option(kwargs.get("sort_keys"), kwargs.get("indent"))
+        return orjson.dumps(obj, default=_default, option=option).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        """
+        Build the jsonify() response straight from orjson's bytes, skipping the
+        decode to str and re-encode that going through dumps() would cost.
+        Pretty-printed in debug mode, like Flask's default provider.
+        """
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(
+            obj, default=_default,
+            option=_option(indent=self._app.debug) | orjson.OPT_APPEND_NEWLINE,
+        )
+        return self._app.response_class(body, mimetype="application/json")
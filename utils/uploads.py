@@ -0,0 +1,45 @@
+import os
+import tempfile
+from typing import Optional
+
+from flask import Request, current_app
+
+# Below this size Werkzeug's in-memory buffer is cheaper than a file on disk
+SPOOL_TO_DISK_THRESHOLD = 500 * 1024
+
+
+class UploadRequest(Request):
+    """
+    Request class that spools large multipart file uploads into *named* temp files
+    under UPLOAD_FOLDER instead of anonymous ones.
+
+    The parser still writes each upload to disk exactly once, but the result now has
+    a path, so handlers can pass it straight to consumers that need a filesystem path
+    (Gemini uploads) or hard-link it into local document storage, instead of copying
+    the spooled file a second time with FileStorage.save().
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= SPOOL_TO_DISK_THRESHOLD:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+        upload_dir = current_app.config.get('UPLOAD_FOLDER') or None
+        if upload_dir:
+            os.makedirs(upload_dir, exist_ok=True)
+        suffix = os.path.splitext(filename or '')[1]
+        # Deleted automatically when the request closes its files
+        return tempfile.NamedTemporaryFile('wb+', suffix=suffix, dir=upload_dir)
+
+
+def spooled_upload_path(file_storage) -> Optional[str]:
+    """
+    Return the on-disk path of an uploaded file spooled by UploadRequest, or None if
+    the upload is held in memory. The path is only valid for the current request.
+    """
+    stream = getattr(file_storage, 'stream', None)
+    path = getattr(stream, 'name', None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    # Make sure everything the form parser wrote is visible to readers of the path
+    stream.flush()
+    return path